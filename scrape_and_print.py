@@ -5,27 +5,25 @@ import os
 import time
 import io
 import base64
+import csv
+import functools
 import logging
 import re
 import sys
+import json
+import glob
+import hashlib
+import zipfile
+from collections import OrderedDict, deque
+from dataclasses import dataclass, fields
 from datetime import datetime
-from PIL import Image, ImageEnhance
-import ddddocr
-import psycopg2
 import random
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.common.exceptions import (
-    TimeoutException,
-    NoSuchElementException,
-    WebDriverException,
-)
+import socket
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import queue
 
 # 設置日誌
 logging.basicConfig(
@@ -42,9 +40,26 @@ PG_CONFIG = {
     "password": os.environ.get("POSTGRES_PASSWORD", "1234"),
 }
 
+# 「查無資料」負面快取的有效天數，期限內的批次會直接略過這些統一編號
+NOT_FOUND_TTL_DAYS = int(os.environ.get("NOT_FOUND_TTL_DAYS", "30"))
+
+
+# 設為 1 時 company_grade 依西元年分區 (只在首次建立或遷移資料表時生效)
+GRADE_PARTITIONED = os.environ.get("GRADE_PARTITIONED") == "1"
+
+
+class CompanyNotFoundError(Exception):
+    """查詢結果為「查無資料」，重試也不會有結果"""
+
+
+class CaptchaFailedError(Exception):
+    """驗證碼嘗試次數用盡，交由重試排程器以 captcha 預算重新排程"""
+
 
 def connect_to_postgres():
     """連接 PostgreSQL 資料庫，如果失敗則返回 None"""
+    import psycopg2
+
     try:
         conn = psycopg2.connect(**PG_CONFIG)
         logging.info("已成功連接到 PostgreSQL 資料庫")
@@ -54,14 +69,216 @@ def connect_to_postgres():
         return None
 
 
+COMPANY_GRADE_DDL = """
+            CREATE TABLE IF NOT EXISTS company_grade (
+                company_id VARCHAR(10) NOT NULL REFERENCES company_basic(company_id) ON DELETE CASCADE,
+                year_ad SMALLINT NOT NULL,
+                year_tw SMALLINT,
+                year_month VARCHAR(30),
+                import_grade SMALLINT REFERENCES grade_level(code),
+                export_grade SMALLINT REFERENCES grade_level(code),
+                fetch_date TIMESTAMP,
+                PRIMARY KEY (company_id, year_ad)
+            )"""
+
+# 程序內快取：級距代碼 (label -> code) 與已建立的年度分區，交易回滾時清空
+_grade_codes = {}
+_grade_partitions = set()
+_grade_partitioned = False
+
+# 資料表與遷移每個程序只需執行一次；重複的 CREATE INDEX IF NOT EXISTS 仍會對資料表取 ShareLock，
+# 與並行的寫入互相等待
+_tables_ready = False
+_tables_lock = threading.Lock()
+
+
+# 實績級距代碼：已知級距使用固定且有序的代碼 (級距越高代碼越大，A 最高)，
+# 可直接以代碼做範圍與趨勢比較；未知的標籤依出現順序附加在 GRADE_EXTRA_CODE_START 之後
+GRADE_LABELS = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "J"]
+GRADE_LEVELS = {label: len(GRADE_LABELS) - i for i, label in enumerate(GRADE_LABELS)}
+GRADE_EXTRA_CODE_START = 100
+
+
+def ensure_grade_schema(cur):
+    """建立正規化的 company_grade 資料表；若為舊版 VARCHAR 結構則遷移資料"""
+    global _grade_partitioned
+
+    cur.execute(
+        """
+            CREATE TABLE IF NOT EXISTS grade_level (
+                code SMALLINT PRIMARY KEY,
+                label VARCHAR(20) UNIQUE NOT NULL
+            )"""
+    )
+    cur.execute(
+        "SELECT column_default FROM information_schema.columns WHERE table_schema = current_schema() "
+        "AND table_name = 'grade_level' AND column_name = 'code'"
+    )
+    if cur.fetchone()[0] is not None:
+        renumber_grade_levels(cur)
+    cur.executemany(
+        "INSERT INTO grade_level (code, label) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+        [(code, label) for label, code in GRADE_LEVELS.items()],
+    )
+    cur.execute(
+        "SELECT data_type FROM information_schema.columns WHERE table_schema = current_schema() "
+        "AND table_name = 'company_grade' AND column_name = 'year_ad'"
+    )
+    row = cur.fetchone()
+    legacy = row is not None and row[0] != "smallint"
+
+    if legacy:
+        logging.info("偵測到舊版 company_grade 結構，開始遷移")
+        cur.execute("ALTER TABLE company_grade RENAME TO company_grade_legacy")
+        cur.execute("ALTER INDEX IF EXISTS company_grade_pkey RENAME TO company_grade_legacy_pkey")
+    if row is None or legacy:
+        cur.execute(
+            COMPANY_GRADE_DDL + (" PARTITION BY RANGE (year_ad)" if GRADE_PARTITIONED else "")
+        )
+
+    cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'company_grade'::regclass")
+    _grade_partitioned = cur.fetchone() is not None
+
+    if legacy:
+        migrate_legacy_grades(cur)
+
+    # 年度趨勢查詢用；單一公司的歷史查詢由主鍵 (company_id, year_ad) 涵蓋
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS company_grade_year_idx "
+        "ON company_grade (year_ad, import_grade, export_grade)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS company_basic_fetch_date_idx ON company_basic (fetch_date, status)"
+    )
+
+
+def renumber_grade_levels(cur):
+    """將舊版依出現順序編號 (SMALLSERIAL) 的 grade_level 改為 GRADE_LEVELS 的固定代碼，
+    並同步更新 company_grade 的參照"""
+    cur.execute("SELECT code, label FROM grade_level ORDER BY code")
+    mapping, extra = [], GRADE_EXTRA_CODE_START
+    for code, label in cur.fetchall():
+        if label in GRADE_LEVELS:
+            mapping.append((code, GRADE_LEVELS[label]))
+        else:
+            mapping.append((code, extra))
+            extra += 1
+    logging.info(f"將 grade_level 的 {len(mapping)} 個級距改為固定代碼")
+
+    cur.execute("ALTER TABLE grade_level ALTER COLUMN code DROP DEFAULT")
+    cur.execute("DROP SEQUENCE IF EXISTS grade_level_code_seq")
+    cur.execute("SELECT to_regclass('company_grade') IS NOT NULL")
+    has_grades = cur.fetchone()[0]
+    if has_grades:
+        cur.execute(
+            "ALTER TABLE company_grade DROP CONSTRAINT IF EXISTS company_grade_import_grade_fkey, "
+            "DROP CONSTRAINT IF EXISTS company_grade_export_grade_fkey"
+        )
+    # 先改為負數，避免新舊代碼互相衝突
+    cur.execute("UPDATE grade_level SET code = -code")
+    cur.executemany("UPDATE grade_level SET code = %s WHERE code = %s", [(new, -old) for old, new in mapping])
+    if has_grades:
+        cur.execute("CREATE TEMP TABLE grade_code_map (old SMALLINT, new SMALLINT) ON COMMIT DROP")
+        cur.executemany("INSERT INTO grade_code_map VALUES (%s, %s)", mapping)
+        for col in ("import_grade", "export_grade"):
+            cur.execute(f"UPDATE company_grade g SET {col} = m.new FROM grade_code_map m WHERE g.{col} = m.old")
+        cur.execute(
+            "ALTER TABLE company_grade "
+            "ADD CONSTRAINT company_grade_import_grade_fkey FOREIGN KEY (import_grade) REFERENCES grade_level(code), "
+            "ADD CONSTRAINT company_grade_export_grade_fkey FOREIGN KEY (export_grade) REFERENCES grade_level(code)"
+        )
+
+
+def migrate_legacy_grades(cur):
+    """將 company_grade_legacy 的 VARCHAR 資料轉入新結構，同公司同年度只保留最新一筆"""
+    cur.execute(
+        """
+        SELECT DISTINCT g FROM (
+            SELECT import_grade AS g FROM company_grade_legacy
+            UNION SELECT export_grade FROM company_grade_legacy
+        ) t WHERE g IS NOT NULL AND g <> ''"""
+    )
+    for (label,) in cur.fetchall():
+        grade_code(cur, label)
+    if _grade_partitioned:
+        cur.execute(
+            "SELECT DISTINCT year_ad::smallint FROM company_grade_legacy WHERE year_ad ~ '^[0-9]{4}$'"
+        )
+        ensure_grade_partitions(cur, {r[0] for r in cur.fetchall()})
+
+    cur.execute(
+        """
+        INSERT INTO company_grade
+            (company_id, year_ad, year_tw, year_month, import_grade, export_grade, fetch_date)
+        SELECT DISTINCT ON (l.company_id, l.year_ad::smallint)
+            l.company_id,
+            l.year_ad::smallint,
+            CASE WHEN l.year_tw ~ '^[0-9]{1,4}$' THEN l.year_tw::smallint END,
+            l.year_month,
+            gi.code,
+            ge.code,
+            l.fetch_date
+        FROM company_grade_legacy l
+        LEFT JOIN grade_level gi ON gi.label = l.import_grade
+        LEFT JOIN grade_level ge ON ge.label = l.export_grade
+        WHERE l.company_id IS NOT NULL AND l.year_ad ~ '^[0-9]{4}$'
+        ORDER BY l.company_id, l.year_ad::smallint, l.fetch_date DESC NULLS LAST, l.id DESC"""
+    )
+    logging.info(f"已遷移 {cur.rowcount} 筆級距資料，舊資料保留在 company_grade_legacy")
+
+
+def ensure_grade_partitions(cur, years):
+    """為分區版 company_grade 建立缺少的年度分區"""
+    for year in sorted(set(years) - _grade_partitions):
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS company_grade_y{int(year)} PARTITION OF company_grade "
+            f"FOR VALUES FROM ({int(year)}) TO ({int(year) + 1})"
+        )
+        _grade_partitions.add(year)
+
+
+def grade_code(cur, label):
+    """返回級距標籤對應的代碼，未知的標籤會以 GRADE_EXTRA_CODE_START 之後的代碼加入 grade_level"""
+    if not label:
+        return None
+    code = _grade_codes.get(label)
+    if code is None:
+        cur.execute("SELECT code FROM grade_level WHERE label = %s", (label,))
+        row = cur.fetchone()
+        if row is None:
+            # 以 advisory lock 序列化新增，避免並行寫入取得相同的代碼
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('grade_level'))")
+            cur.execute(
+                "INSERT INTO grade_level (code, label) "
+                "SELECT GREATEST(%s, COALESCE(MAX(code), 0) + 1), %s FROM grade_level "
+                "ON CONFLICT (label) DO NOTHING",
+                (GRADE_EXTRA_CODE_START, label),
+            )
+            cur.execute("SELECT code FROM grade_level WHERE label = %s", (label,))
+            row = cur.fetchone()
+        code = _grade_codes[label] = row[0]
+    return code
+
+
 def create_tables(conn):
-    """確保必要的資料表存在"""
+    """確保必要的資料表存在 (每個程序只在第一次成功時實際執行)"""
     if not conn:
         logging.warning("無法建立資料表：資料庫連接失敗")
         return False
 
+    with _tables_lock:
+        if _tables_ready:
+            return True
+        return _create_tables(conn)
+
+
+def _create_tables(conn):
+    global _tables_ready
+
     try:
         with conn.cursor() as cur:
+            # 多個程序同時啟動時序列化建表與遷移，交易結束時自動釋放
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('scrape_and_print.create_tables'))")
             cur.execute(
                 """
             CREATE TABLE IF NOT EXISTS company_basic (
@@ -77,16 +294,7 @@ def create_tables(conn):
                 status VARCHAR(20) DEFAULT 'success'
             )"""
             )
-            cur.execute(
-                """
-            CREATE TABLE IF NOT EXISTS company_grade (
-                id SERIAL PRIMARY KEY,
-                company_id VARCHAR(10) REFERENCES company_basic(company_id) ON DELETE CASCADE,
-                year_month VARCHAR(30), year_tw VARCHAR(10), year_ad VARCHAR(10),
-                import_grade VARCHAR(10), export_grade VARCHAR(10),
-                fetch_date TIMESTAMP
-            )"""
-            )
+            ensure_grade_schema(cur)
             # 新增錯誤記錄表
             cur.execute(
                 """
@@ -98,7 +306,17 @@ def create_tables(conn):
                 stack_trace TEXT
             )"""
             )
+            # 「查無資料」負面快取
+            cur.execute(
+                """
+            CREATE TABLE IF NOT EXISTS company_not_found (
+                company_id VARCHAR(10) PRIMARY KEY,
+                checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                hits INTEGER DEFAULT 1
+            )"""
+            )
             conn.commit()
+        _tables_ready = True
         logging.info("必要的資料表已創建或存在")
         return True
     except Exception as e:
@@ -108,17 +326,75 @@ def create_tables(conn):
         return False
 
 
-def preprocess_captcha(img: Image.Image) -> Image.Image:
+def preprocess_captcha(img: "Image.Image") -> "Image.Image":
     """預處理驗證碼圖片以提高辨識率"""
+    from PIL import Image, ImageEnhance
+
     img = img.convert("L").resize((img.width * 2, img.height * 2), Image.LANCZOS)
     img = ImageEnhance.Contrast(img).enhance(2.0)
     img = ImageEnhance.Sharpness(img).enhance(2.0)
     return img.point(lambda x: 255 if x > 150 else 0)
 
 
-def recognize_captcha(img: Image.Image, max_attempts=3) -> str:
+@functools.lru_cache(maxsize=None)
+def _selenium_names():
+    from selenium import webdriver
+    from selenium.common.exceptions import (
+        InvalidSessionIdException,
+        NoSuchElementException,
+        NoSuchWindowException,
+        TimeoutException,
+        WebDriverException,
+    )
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.remote.webdriver import WebDriver
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    return {
+        "webdriver": webdriver,
+        "Options": Options,
+        "By": By,
+        "WebDriver": WebDriver,
+        "WebDriverWait": WebDriverWait,
+        "EC": EC,
+        "TimeoutException": TimeoutException,
+        "NoSuchElementException": NoSuchElementException,
+        "WebDriverException": WebDriverException,
+        "InvalidSessionIdException": InvalidSessionIdException,
+        "NoSuchWindowException": NoSuchWindowException,
+    }
+
+
+def selenium_api(*names):
+    """延遲載入 Selenium (第一次呼叫時才 import)，依名稱返回對應的模組或類別；
+    只指定一個名稱時直接返回該物件
+
+    例：By, WebDriverWait, EC = selenium_api("By", "WebDriverWait", "EC")
+    """
+    api = _selenium_names()
+    return api[names[0]] if len(names) == 1 else tuple(api[n] for n in names)
+
+
+_ocr = None
+_ocr_lock = threading.Lock()
+
+
+def get_ocr():
+    """返回共用的 ddddocr 辨識器 (模型只載入一次，可跨執行緒使用)"""
+    global _ocr
+    with _ocr_lock:
+        if _ocr is None:
+            import ddddocr
+
+            _ocr = ddddocr.DdddOcr(show_ad=False)
+        return _ocr
+
+
+def recognize_captcha(img: "Image.Image", max_attempts=3) -> str:
     """嘗試辨識驗證碼，失敗後會進行多次嘗試，支持3位數或4位數驗證碼"""
-    ocr = ddddocr.DdddOcr(show_ad=False)
+    ocr = get_ocr()
 
     for attempt in range(max_attempts):
         try:
@@ -155,8 +431,105 @@ def recognize_captcha(img: Image.Image, max_attempts=3) -> str:
                 return "000"  # 最後一次嘗試失敗，返回默認為3位數的值
             time.sleep(1)  # 暫停後再試
 
-def setup_driver(download_dir: str, headless=True):
-    """設置並返回 Selenium WebDriver"""
+
+# 網站網址 (可用 FBFH_BASE_URL 指向測試用的模擬站台)
+BASE_URL = os.environ.get("FBFH_BASE_URL", "https://fbfh.trade.gov.tw").rstrip("/")
+QUERY_URL = f"{BASE_URL}/fb/web/queryBasicf.do"
+
+# WebDriver 設定檔
+#   lean: 封鎖字型、媒體、裝飾圖片與第三方追蹤腳本，關閉背景服務，eager 載入策略，共用磁碟快取
+#   full: 完整載入頁面 (原本的行為)
+# 驗證碼圖片 (realPic) 不在封鎖清單內，可用 SCRAPER_BLOCKED_URLS (逗號分隔) 覆寫封鎖清單
+DRIVER_PROFILES = {
+    "lean": {
+        "page_load_strategy": "eager",
+        "args": [
+            "--disable-extensions",
+            "--disable-background-networking",
+            "--disable-component-update",
+            "--disable-default-apps",
+            "--disable-sync",
+            "--no-first-run",
+            "--mute-audio",
+        ],
+        "blocked_urls": (
+            os.environ["SCRAPER_BLOCKED_URLS"].split(",")
+            if os.environ.get("SCRAPER_BLOCKED_URLS")
+            else [
+                "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+                "*.gif", "*.svg", "*.ico", "*.webp",
+                "*.mp4", "*.webm", "*.mp3",
+                "*google-analytics.com*", "*googletagmanager.com*",
+                "*doubleclick.net*", "*facebook.net*", "*facebook.com/tr*",
+            ]
+        ),
+        "disk_cache": True,
+    },
+    "full": {
+        "page_load_strategy": "normal",
+        "args": [],
+        "blocked_urls": [],
+        "disk_cache": False,
+    },
+}
+
+# 各角色使用的設定檔：scrape 為查詢與擷取，render 為需要完整頁面的 PDF 輸出
+DRIVER_ROLES = {
+    "scrape": os.environ.get("SCRAPE_DRIVER_PROFILE", "lean"),
+    "render": os.environ.get("RENDER_DRIVER_PROFILE", "full"),
+}
+
+# lean 設定檔的磁碟快取根目錄與每個快取槽的容量上限 (超過時由 Chrome 依 LRU 淘汰)
+# Chrome 的磁碟快取不支援多個瀏覽器同時使用，每隻 driver 獨占一個快取槽 (slot-N)，
+# 關閉後留給下一隻 driver 沿用；同時執行的 driver 超過 SHARED_CACHE_SLOTS 時不使用磁碟快取
+SHARED_CACHE_DIR = os.environ.get("SCRAPER_CACHE_DIR", "/tmp/fbfh_chrome_cache")
+SHARED_CACHE_SIZE_MB = int(os.environ.get("SCRAPER_CACHE_SIZE_MB", "200"))
+SHARED_CACHE_SLOTS = int(os.environ.get("SCRAPER_CACHE_SLOTS", "8"))
+
+
+def acquire_cache_slot():
+    """取得一個獨占的快取槽，返回 (目錄, 鎖定檔)；全部使用中時返回 (None, None)
+
+    以 flock 鎖定，多個執行緒與多個程序 (例如同一主機上的多個節點) 都不會共用同一個快取槽。
+    鎖定檔關閉時釋放。
+    """
+    import fcntl
+
+    os.makedirs(SHARED_CACHE_DIR, exist_ok=True)
+    for n in range(SHARED_CACHE_SLOTS):
+        path = os.path.join(SHARED_CACHE_DIR, f"slot-{n}")
+        lock = open(f"{path}.lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        return path, lock
+    return None, None
+
+# 網站的靜態資源 (可快取)；其他同站請求 (.do 查詢、驗證碼圖片) 視為動態內容
+STATIC_ASSET_RE = re.compile(
+    rf"^{re.escape(BASE_URL)}/.*\.(?:js|css|png|jpe?g|gif|svg|ico|woff2?|ttf)(?:\?.*)?$",
+    re.IGNORECASE,
+)
+DYNAMIC_URL_RE = re.compile(rf"^{re.escape(BASE_URL)}/", re.IGNORECASE)
+
+# 共用快取命中統計 (程序內累計)
+CACHE_STATS = {"hits": 0, "misses": 0, "dynamic_cached": 0}
+
+
+def setup_driver(download_dir: str, headless=True, role="scrape", profile=None):
+    """設置並返回 Selenium WebDriver
+
+    參數:
+        role: 驅動角色 (scrape/render)，依 DRIVER_ROLES 選擇設定檔
+        profile: 直接指定 DRIVER_PROFILES 的設定檔名稱，優先於 role
+    """
+    webdriver, Options = selenium_api("webdriver", "Options")
+
+    profile_name = profile or DRIVER_ROLES.get(role, "full")
+    cfg = DRIVER_PROFILES[profile_name]
+
     opts = Options()
     if headless:
         for flag in [
@@ -167,6 +540,20 @@ def setup_driver(download_dir: str, headless=True):
             "--window-size=1920,1080",
         ]:
             opts.add_argument(flag)
+
+    for flag in cfg["args"]:
+        opts.add_argument(flag)
+    cache_lock = None
+    if cfg["disk_cache"]:
+        cache_dir, cache_lock = acquire_cache_slot()
+        if cache_dir:
+            opts.add_argument(f"--disk-cache-dir={cache_dir}")
+            opts.add_argument(f"--disk-cache-size={SHARED_CACHE_SIZE_MB * 1024 * 1024}")
+        else:
+            logging.warning(f"快取槽已全部使用中 ({SHARED_CACHE_SLOTS} 個)，此 driver 不使用共用磁碟快取")
+        # 開啟效能日誌，用於統計快取命中
+        opts.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    opts.page_load_strategy = cfg["page_load_strategy"]
     
     # 添加代理設定（如果需要）
     # opts.add_argument('--proxy-server=http://your-proxy:port')
@@ -178,9 +565,10 @@ def setup_driver(download_dir: str, headless=True):
     }
     opts.add_experimental_option("prefs", prefs)
 
+    driver = None
     try:
         # 在Docker中使用內建Chrome瀏覽器
-        logging.info("嘗試直接使用Docker中的Chrome瀏覽器...")
+        logging.info(f"嘗試直接使用Docker中的Chrome瀏覽器 (角色: {role}，設定檔: {profile_name})...")
         
         # 檢查Docker中的Chrome路徑
         chrome_paths = [
@@ -195,13 +583,354 @@ def setup_driver(download_dir: str, headless=True):
                 break
                 
         # 不使用Service類別，直接創建ChromeDriver
-        driver = webdriver.Chrome(options=opts)
+        # 啟動期間新出現的行程不會被當成孤兒清除 (見 DriverWatchdog.begin_launch)
+        launch = WATCHDOG.begin_launch()
+        try:
+            driver = webdriver.Chrome(options=opts)
+            WATCHDOG.register(driver, role, cache_lock)
+        finally:
+            WATCHDOG.end_launch(launch)
         driver.set_page_load_timeout(30)
+
+        # 透過 CDP 封鎖不需要的資源
+        if cfg["blocked_urls"]:
+            try:
+                driver.execute_cdp_cmd("Network.enable", {})
+                driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": cfg["blocked_urls"]})
+            except Exception as e:
+                logging.warning(f"設定資源封鎖失敗：{e}")
         return driver
         
     except Exception as e:
         logging.error(f"初始化Chrome WebDriver失敗：{e}")
-        
+        # 啟動失敗時 chromedriver/Chrome 可能已經啟動，立即清除
+        if driver:
+            quit_driver(driver, "初始化失敗的 WebDriver")
+        else:
+            WATCHDOG.sweep()
+            if cache_lock:
+                cache_lock.close()
+        return None
+
+
+def collect_cache_stats(driver):
+    """讀取 driver 的效能日誌，累計靜態資源的快取命中/未命中次數到 CACHE_STATS
+
+    動態內容 (查詢結果、驗證碼) 不應被快取；若發現從快取載入則記錄警告。
+    """
+    try:
+        entries = driver.get_log("performance")
+    except Exception:
+        return  # 未開啟效能日誌 (非 lean 設定檔)
+
+    for entry in entries:
+        try:
+            msg = json.loads(entry["message"])["message"]
+            if msg.get("method") != "Network.responseReceived":
+                continue
+            resp = msg["params"]["response"]
+        except (KeyError, ValueError):
+            continue
+
+        url = resp.get("url", "")
+        cached = resp.get("fromDiskCache") or resp.get("fromMemoryCache")
+        if STATIC_ASSET_RE.match(url):
+            CACHE_STATS["hits" if cached else "misses"] += 1
+        elif cached and DYNAMIC_URL_RE.match(url):
+            CACHE_STATS["dynamic_cached"] += 1
+            logging.warning(f"動態內容從快取載入：{url}")
+
+
+def _proc_table():
+    """讀取 /proc，返回 {pid: (父行程 ID, 狀態, 行程名稱)}，僅支援 Linux"""
+    table = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # 行程名稱可能含空白，從最後一個 ')' 之後切割其餘欄位
+                head, tail = f.read().rsplit(")", 1)
+            stat = tail.split()
+            table[int(entry)] = (int(stat[1]), stat[0], head.split("(", 1)[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    return table
+
+
+def _process_tree(table, root_pid):
+    """返回 root_pid 及其所有子孫行程的 ID 列表"""
+    children = {}
+    for pid, (ppid, _, _) in table.items():
+        children.setdefault(ppid, []).append(pid)
+    tree, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, []))
+    return tree
+
+
+def _rss_kb(pid):
+    """讀取單一行程的 RSS (KB)，行程不存在時返回 0"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _proc_alive(pid, name):
+    """行程仍在執行 (非殭屍) 且名稱相同時返回 True"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            head, tail = f.read().rsplit(")", 1)
+    except OSError:
+        return False
+    return head.split("(", 1)[1] == name and tail.split()[0] != "Z"
+
+
+def process_tree_rss_kb(root_pid):
+    """計算指定行程及其所有子行程的 RSS 總和 (KB)，僅支援 Linux /proc"""
+    return sum(_rss_kb(pid) for pid in _process_tree(_proc_table(), root_pid))
+
+
+# 瀏覽器行程監控
+#   DRIVER_MAX_RSS_MB: 會話的瀏覽器行程樹超過此記憶體用量即重建 driver
+#   DRIVER_MAX_COMPANIES: 同一會話服務超過此公司數即重建 driver
+#   WATCHDOG_INTERVAL: 清除孤兒行程、回收殭屍行程的間隔秒數
+DRIVER_MAX_RSS_MB = int(os.environ.get("DRIVER_MAX_RSS_MB", "1536"))
+DRIVER_MAX_COMPANIES = int(os.environ.get("DRIVER_MAX_COMPANIES", "50"))
+WATCHDOG_INTERVAL = int(os.environ.get("WATCHDOG_INTERVAL", "30"))
+
+
+def _is_browser_process(name):
+    """依 /proc 行程名稱判斷是否為 Chrome/chromedriver 行程"""
+    return name.startswith("chrome") or name == "google-chrome"
+
+
+class DriverWatchdog:
+    """追蹤每隻 WebDriver 的 chromedriver/Chrome 行程
+
+    driver 關閉後強制結束殘留的行程樹；背景執行緒定期清除掛在本程序下、
+    不屬於任何 driver 的瀏覽器行程 (孤兒) 並回收殭屍行程，同時記錄記憶體指標。
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.drivers = {}  # id(driver) -> {"pid": chromedriver 行程 ID, "role": 角色}
+        self.zombies_reaped = 0
+        self.orphans_killed = 0
+        self.recycled = 0
+        self.launching = {}  # 啟動代號 -> 開始啟動時已存在的行程 ID
+        self._launch_seq = 0
+        self._thread = None
+
+    def begin_launch(self):
+        """記錄一次 driver 啟動；啟動期間新出現的行程尚未註冊，sweep() 不會清除"""
+        existing = set(_proc_table())
+        with self.lock:
+            self._launch_seq += 1
+            self.launching[self._launch_seq] = existing
+            return self._launch_seq
+
+    def end_launch(self, token):
+        with self.lock:
+            self.launching.pop(token, None)
+
+    def register(self, driver, role, cache_lock=None):
+        try:
+            pid = driver.service.process.pid
+        except AttributeError:
+            pid = None
+        with self.lock:
+            self.drivers[id(driver)] = {"pid": pid, "role": role, "cache_lock": cache_lock}
+
+    def release(self, driver):
+        """取消追蹤 driver，返回 (目前的行程樹, 快取槽鎖定檔)；行程樹用來檢查關閉後的殘留行程，
+        快取槽在瀏覽器行程結束後才釋放"""
+        with self.lock:
+            info = self.drivers.pop(id(driver), None)
+        if info is None or info["pid"] is None:
+            return [], info and info["cache_lock"]
+        return [(pid, name) for pid, (_, _, name) in self._tree(info["pid"])], info["cache_lock"]
+
+    def _tree(self, root_pid, table=None):
+        table = table or _proc_table()
+        return [(pid, table[pid]) for pid in _process_tree(table, root_pid) if pid in table]
+
+    def rss_kb(self, driver):
+        """driver 的 chromedriver + Chrome 行程樹 RSS 總和 (KB)"""
+        info = self.drivers.get(id(driver))
+        return process_tree_rss_kb(info["pid"]) if info and info["pid"] else 0
+
+    def kill_leftovers(self, pids, grace=1.0, poll=0.05):
+        """等待 driver.quit() 之後的瀏覽器行程結束，超過 grace 秒仍存在者強制結束"""
+        deadline = time.monotonic() + grace
+        while pids:
+            # 確認行程名稱沒變，避免誤殺重複使用 PID 的其他行程
+            pids = [(pid, name) for pid, name in pids if _proc_alive(pid, name)]
+            if not pids or time.monotonic() >= deadline:
+                break
+            time.sleep(poll)
+        for pid, name in pids:
+            self._kill(pid, name)
+        self.reap()
+
+    def _kill(self, pid, name):
+        import signal
+
+        try:
+            os.kill(pid, signal.SIGKILL)
+            self.orphans_killed += 1
+            logging.warning(f"[watchdog] 強制結束殘留的瀏覽器行程 {name} (PID {pid})")
+        except OSError:
+            pass
+
+    def reap(self, table=None):
+        """回收本程序下的殭屍行程，返回回收數量"""
+        table = table or _proc_table()
+        me, reaped = os.getpid(), 0
+        for pid, (ppid, state, _) in table.items():
+            if ppid != me or state != "Z":
+                continue
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    reaped += 1
+            except ChildProcessError:
+                continue
+        self.zombies_reaped += reaped
+        return reaped
+
+    def sweep(self):
+        """清除不屬於任何 driver 的瀏覽器行程並回收殭屍行程"""
+        with self.lock:
+            table = _proc_table()
+            owned = set()
+            for info in self.drivers.values():
+                if info["pid"]:
+                    owned.update(_process_tree(table, info["pid"]))
+            me = os.getpid()
+            for pid, (ppid, state, name) in table.items():
+                if ppid != me or pid in owned or state == "Z" or not _is_browser_process(name):
+                    continue
+                # 仍在啟動中的 driver 的行程
+                if any(pid not in existing for existing in self.launching.values()):
+                    continue
+                # crashpad 會脫離 Chrome 行程樹，只在沒有任何 driver 時才算孤兒
+                if name.startswith("chrome_crashpad") and self.drivers:
+                    continue
+                self._kill(pid, name)
+            self.reap()
+
+    def gauges(self):
+        """記憶體與行程數量指標"""
+        table = _proc_table()
+        me = os.getpid()
+        browser = [
+            pid
+            for pid, (_, state, name) in self._tree(me, table)
+            if state != "Z" and _is_browser_process(name)
+        ]
+        return {
+            "drivers": len(self.drivers),
+            "browser_processes": len(browser),
+            "browser_rss_mb": round(sum(_rss_kb(pid) for pid in browser) / 1024, 1),
+            "self_rss_mb": round(_rss_kb(me) / 1024, 1),
+            "zombies": sum(1 for ppid, state, _ in table.values() if ppid == me and state == "Z"),
+            "zombies_reaped": self.zombies_reaped,
+            "orphans_killed": self.orphans_killed,
+            "drivers_recycled": self.recycled,
+        }
+
+    def start(self, interval=WATCHDOG_INTERVAL):
+        """啟動背景監控執行緒 (重複呼叫不會啟動第二個)"""
+        if self._thread or not os.path.isdir("/proc"):
+            return
+        enable_child_subreaper()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="driver-watchdog", daemon=True)
+        self._thread.start()
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.sweep()
+                g = self.gauges()
+                logging.info(
+                    f"[watchdog] driver {g['drivers']} 隻，瀏覽器行程 {g['browser_processes']} 個 "
+                    f"({g['browser_rss_mb']:.0f} MB)，本程序 {g['self_rss_mb']:.0f} MB，"
+                    f"已回收殭屍 {g['zombies_reaped']} 個、清除孤兒 {g['orphans_killed']} 個"
+                )
+            except Exception as e:
+                logging.warning(f"[watchdog] 監控失敗：{e}")
+
+
+def enable_child_subreaper():
+    """將本程序設為 child subreaper (Linux)，讓 Chrome 遺留的孫行程掛回本程序以便清除與回收"""
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        import ctypes
+
+        PR_SET_CHILD_SUBREAPER = 36
+        return ctypes.CDLL(None, use_errno=True).prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (OSError, AttributeError) as e:
+        logging.warning(f"無法設定 child subreaper：{e}")
+        return False
+
+
+WATCHDOG = DriverWatchdog()
+
+
+def quit_driver(driver, label="WebDriver"):
+    """關閉 driver；quit 失敗或有行程殘留時強制結束整個瀏覽器行程樹"""
+    if driver is None:
+        return
+    pids, cache_lock = WATCHDOG.release(driver)
+    try:
+        collect_cache_stats(driver)
+        driver.quit()
+        logging.info(f"{label} 已關閉")
+    except Exception as e:
+        logging.warning(f"關閉 {label} 時出錯：{e}")
+    WATCHDOG.kill_leftovers(pids)
+    if cache_lock:
+        cache_lock.close()
+
+
+def benchmark_driver_profiles(pages=5, download_dir="downloads"):
+    """比較各 WebDriver 設定檔載入查詢頁面的延遲與記憶體用量"""
+    results = {}
+    for name in DRIVER_PROFILES:
+        driver = setup_driver(download_dir, profile=name)
+        if driver is None:
+            continue
+        try:
+            latencies = []
+            for _ in range(pages):
+                t0 = time.perf_counter()
+                driver.get(QUERY_URL)
+                latencies.append(time.perf_counter() - t0)
+            rss = process_tree_rss_kb(driver.service.process.pid)
+            results[name] = {
+                "avg_latency": sum(latencies) / len(latencies),
+                "max_latency": max(latencies),
+                "rss_mb": rss / 1024,
+            }
+        finally:
+            quit_driver(driver, f"{name} 設定檔 WebDriver")
+
+    logging.info(f"===== WebDriver 設定檔比較 ({pages} 次頁面載入) =====")
+    for name, r in results.items():
+        logging.info(
+            f"{name:>5}: 平均 {r['avg_latency']:.2f}s，最慢 {r['max_latency']:.2f}s，"
+            f"瀏覽器記憶體 {r['rss_mb']:.0f} MB"
+        )
+    return results
 
 
 def save_html_to_pdf(driver, html_content, output_path, title):
@@ -239,6 +968,8 @@ def save_html_to_pdf(driver, html_content, output_path, title):
 
 def close_modal_dialog(driver, max_attempts=3):
     """嘗試關閉模態對話框"""
+    By, WebDriverWait, EC = selenium_api("By", "WebDriverWait", "EC")
+
     for attempt in range(max_attempts):
         try:
             for xpath in [
@@ -269,61 +1000,173 @@ def close_modal_dialog(driver, max_attempts=3):
             time.sleep(1)  # 暫停後再試
 
 
+@dataclass(slots=True)
+class CompanyBasic:
+    """公司基本資料 (欄位順序與 company_basic 資料表一致)"""
+
+    company_id: str = ""
+    issue_date: str = ""
+    reg_date: str = ""
+    cn_name: str = ""
+    en_name: str = ""
+    cn_address: str = ""
+    en_address: str = ""
+    representative: str = ""
+    tel1: str = ""
+    tel2: str = ""
+    fax: str = ""
+    old_cn_name: str = ""
+    old_en_name: str = ""
+    website: str = ""
+    email: str = ""
+    import_qualification: str = ""
+    export_qualification: str = ""
+    import_items_cn: str = ""
+    import_items_en: str = ""
+    export_items_cn: str = ""
+    export_items_en: str = ""
+
+    def to_row(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    def filled_count(self):
+        """已取得 (非空白) 的欄位數"""
+        return sum(1 for v in self.to_row() if v)
+
+
+@dataclass(slots=True)
+class GradeRow:
+    """一筆實績級距資料 (對應 company_grade 資料表的一列)"""
+
+    year_month: str = ""
+    year_tw: int | None = None
+    year_ad: int | None = None
+    import_grade: str = ""  # 級距標籤，寫入資料庫時轉為 grade_level 代碼
+    export_grade: str = ""
+
+    def to_row(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+
+def result_to_json(cid, result):
+    """將 extract_company_data 的結果序列化為一行緊湊 JSON，供階段間的佇列或檔案使用"""
+    basic = result.get("basic")
+    return json.dumps(
+        [
+            cid,
+            result.get("status"),
+            result.get("failure"),
+            basic.to_row() if basic else None,
+            [g.to_row() for g in result.get("grades", [])],
+        ],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+def result_from_json(line):
+    """result_to_json 的反向操作，返回 (統一編號, 結果)"""
+    cid, status, failure, basic, grades = json.loads(line)
+    return cid, {
+        "status": status,
+        "failure": failure,
+        "basic": CompanyBasic.from_row(basic) if basic else None,
+        "grades": [GradeRow.from_row(g) for g in grades],
+    }
+
+
+# 基本資料卡片欄位：元素 ID -> (CompanyBasic 屬性, 中文欄位名稱)
+BASIC_FIELD_MAP = {
+    "banNoM": ("company_id", "統一編號"),
+    "issueDateM": ("issue_date", "核發日期"),
+    "regDateM": ("reg_date", "原始登記日期"),
+    "cNameM": ("cn_name", "廠商中文名稱"),
+    "eNameM": ("en_name", "廠商英文名稱"),
+    "cAdressM": ("cn_address", "中文營業地址"),
+    "eAdressM": ("en_address", "英文營業地址"),
+    "regNameM": ("representative", "代表人"),
+    "tel1M": ("tel1", "電話號碼1"),
+    "tel2M": ("tel2", "電話號碼2"),
+    "faxM": ("fax", "傳真號碼"),
+    "oldCNameM": ("old_cn_name", "原中文名稱"),
+    "oldENameM": ("old_en_name", "原英文名稱"),
+    "urlM": ("website", "網站"),
+    "emailM": ("email", "電子信箱"),
+    "importM": ("import_qualification", "進口資格"),
+    "exportM": ("export_qualification", "出口資格"),
+}
+
+# 產品項目欄位
+STOCK_FIELD_MAP = [
+    ("cStockIM", "import_items_cn", "進口項目(中)"),
+    ("eStockIM", "import_items_en", "進口項目(英)"),
+    ("cStockEM", "export_items_cn", "出口項目(中)"),
+    ("eStockEM", "export_items_en", "出口項目(英)"),
+]
+
+
 def extract_basic_data(driver):
     """擷取公司基本資料"""
-    field_map = {
-        "banNoM": "統一編號",
-        "issueDateM": "核發日期",
-        "regDateM": "原始登記日期",
-        "cNameM": "廠商中文名稱",
-        "eNameM": "廠商英文名稱",
-        "cAdressM": "中文營業地址",
-        "eAdressM": "英文營業地址",
-        "regNameM": "代表人",
-        "tel1M": "電話號碼1",
-        "tel2M": "電話號碼2",
-        "faxM": "傳真號碼",
-        "oldCNameM": "原中文名稱",
-        "oldENameM": "原英文名稱",
-        "urlM": "網站",
-        "emailM": "電子信箱",
-        "importM": "進口資格",
-        "exportM": "出口資格",
-    }
-    data = {}
+    By = selenium_api("By")
 
-    for fid, name in field_map.items():
+    data = CompanyBasic()
+
+    for fid, (attr, name) in BASIC_FIELD_MAP.items():
         try:
             el = driver.find_element(By.ID, fid)
             if fid == "urlM":
                 a = el.find_elements(By.TAG_NAME, "a")
-                data[name] = a[0].get_attribute("href") if a else ""
+                value = a[0].get_attribute("href") if a else ""
             else:
                 sp = el.find_elements(By.TAG_NAME, "span")
-                data[name] = sp[0].text.strip() if sp else el.text.strip()
+                value = sp[0].text.strip() if sp else el.text.strip()
+            setattr(data, attr, value or "")
         except Exception as e:
             logging.warning(f"擷取欄位 '{name}' 時出錯：{e}")
-            data[name] = ""
 
     # 產品項目
-    for fid, name in [
-        ("cStockIM", "進口項目(中)"),
-        ("eStockIM", "進口項目(英)"),
-        ("cStockEM", "出口項目(中)"),
-        ("eStockEM", "出口項目(英)"),
-    ]:
+    for fid, attr, name in STOCK_FIELD_MAP:
         try:
             sp = driver.find_element(By.ID, fid).find_element(By.TAG_NAME, "span")
-            data[name] = sp.text.strip()
+            setattr(data, attr, sp.text.strip())
         except:
-            data[name] = ""
+            pass
 
     logging.info(f"擷取基本資料：{data}")
     return data
 
 
+def parse_grade_row(cells):
+    """將級距表格一列的儲存格文字轉為 GradeRow，欄位不足時返回 None"""
+    if len(cells) < 3:
+        return None
+
+    txt = cells[0].strip().split("\n")
+    tw, en = txt[0], txt[1] if len(txt) > 1 else ""
+    tw_y = re.search(r"(\d+)年", tw)
+    ad_y = re.search(r"(\d{4})", en)
+
+    return GradeRow(
+        year_month=tw + "/" + en,
+        year_tw=int(tw_y.group(1)) if tw_y else None,
+        year_ad=int(ad_y.group(1)) if ad_y else None,
+        import_grade=cells[1].strip(),
+        export_grade=cells[2].strip(),
+    )
+
+
 def extract_grade_data(driver):
     """擷取公司實績級距資料"""
+    By = selenium_api("By")
+
     grades = []
     try:
         tbl = driver.find_element(By.CSS_SELECTOR, "#popGradeCard table.table-bordered")
@@ -332,29 +1175,9 @@ def extract_grade_data(driver):
         for r in rows:
             try:
                 td = r.find_elements(By.TAG_NAME, "td")
-                if len(td) >= 3:
-                    txt = td[0].text.strip().split("\n")
-                    tw, en = txt[0], txt[1] if len(txt) > 1 else ""
-                    tw_y = (
-                        re.search(r"(\d+)年", tw).group(1)
-                        if re.search(r"(\d+)年", tw)
-                        else ""
-                    )
-                    ad_y = (
-                        re.search(r"(\d{4})", en).group(1)
-                        if re.search(r"(\d{4})", en)
-                        else ""
-                    )
-
-                    grades.append(
-                        {
-                            "年月": tw + "/" + en,
-                            "民國年": tw_y,
-                            "西元年": ad_y,
-                            "進口級距": td[1].text.strip(),
-                            "出口級距": td[2].text.strip(),
-                        }
-                    )
+                g = parse_grade_row([c.text for c in td])
+                if g:
+                    grades.append(g)
             except Exception as e:
                 logging.warning(f"解析級距資料列時發生錯誤：{e}")
                 continue
@@ -366,8 +1189,196 @@ def extract_grade_data(driver):
         return []
 
 
+# 區塊元素前後換行 (對應 WebDriver 可見文字的行為)
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "caption", "dd", "div", "dl", "dt",
+    "fieldset", "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5",
+    "h6", "header", "hr", "li", "main", "nav", "ol", "p", "pre", "section", "table",
+    "tbody", "tfoot", "thead", "tr", "ul",
+}
+
+
+def element_text(el):
+    """近似 Selenium WebElement.text 的可見文字
+
+    行內文字直接相連、連續空白合併為一個空格 (&nbsp; 視為空格)，只有 <br> 與區塊元素
+    產生換行，表格儲存格之間以空格分隔，每行去除首尾空白。
+    """
+    from bs4 import Comment, NavigableString
+
+    lines, current = [], []
+
+    def soft_break():
+        # 區塊邊界：目前行有內容才換行，不產生空行
+        if "".join(current).strip():
+            lines.append("".join(current))
+        current.clear()
+
+    def walk(node):
+        for child in node.children:
+            if isinstance(child, Comment):
+                continue
+            if isinstance(child, NavigableString):
+                current.append(re.sub(r"[ \t\r\n\f]+", " ", str(child)))
+                continue
+            style = (child.get("style") or "").replace(" ", "").lower()
+            if child.name in ("script", "style", "template") or child.has_attr("hidden") or "display:none" in style:
+                continue
+            if child.name == "br":
+                lines.append("".join(current))
+                current.clear()
+            elif child.name in BLOCK_TAGS:
+                soft_break()
+                walk(child)
+                soft_break()
+            else:
+                if child.name in ("td", "th"):
+                    current.append(" ")
+                walk(child)
+
+    walk(el)
+    soft_break()
+    lines = [re.sub(" +", " ", line.replace("\xa0", " ")).strip() for line in lines]
+    while lines and not lines[0]:
+        lines.pop(0)
+    while lines and not lines[-1]:
+        lines.pop()
+    return "\n".join(lines)
+
+
+def parse_basic_html(html):
+    """從基本資料卡片 HTML 擷取公司基本資料，規則與 extract_basic_data 相同"""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "lxml")
+    data = CompanyBasic()
+
+    for fid, (attr, name) in BASIC_FIELD_MAP.items():
+        el = soup.find(id=fid)
+        if el is None:
+            logging.warning(f"擷取欄位 '{name}' 時出錯：找不到元素 {fid}")
+        elif fid == "urlM":
+            a = el.find("a")
+            setattr(data, attr, a.get("href", "") if a else "")
+        else:
+            sp = el.find("span")
+            setattr(data, attr, element_text(sp or el))
+
+    for fid, attr, name in STOCK_FIELD_MAP:
+        el = soup.find(id=fid)
+        sp = el.find("span") if el else None
+        setattr(data, attr, element_text(sp) if sp else "")
+
+    return data
+
+
+def parse_grade_html(html):
+    """從級距卡片 HTML 擷取實績級距，規則與 extract_grade_data 相同"""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "lxml")
+    tbl = soup.select_one("#popGradeCard table.table-bordered")
+    if tbl is None:
+        logging.error("擷取級距資料失敗：找不到級距表格")
+        return []
+
+    grades = []
+    for r in tbl.find_all("tr")[3:]:  # 跳過標題列
+        g = parse_grade_row([element_text(td) for td in r.find_all("td")])
+        if g:
+            grades.append(g)
+    return grades
+
+
+def start_recording(record_dir, cid):
+    """建立 (或覆寫) 公司的錄製封存檔 <record_dir>/<cid>.zip"""
+    if not record_dir:
+        return
+    try:
+        os.makedirs(record_dir, exist_ok=True)
+        meta = {"company_id": cid, "recorded_at": datetime.now().isoformat()}
+        with zipfile.ZipFile(
+            os.path.join(record_dir, f"{cid}.zip"), "w", compression=zipfile.ZIP_DEFLATED
+        ) as zf:
+            zf.writestr("meta.json", json.dumps(meta, ensure_ascii=False))
+    except Exception as e:
+        logging.warning(f"建立錄製檔案失敗：{e}")
+
+
+def record_fixture(record_dir, cid, name, data):
+    """將卡片 HTML 或驗證碼圖片寫入公司的錄製封存檔"""
+    if not record_dir or not cid:
+        return
+    try:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with zipfile.ZipFile(
+            os.path.join(record_dir, f"{cid}.zip"), "a", compression=zipfile.ZIP_DEFLATED
+        ) as zf:
+            if name.endswith("/"):
+                # 目錄型名稱：依現有檔案數自動編號，例如 captcha/03.png
+                n = sum(1 for f in zf.namelist() if f.startswith(name))
+                name = f"{name}{n:02d}.png"
+            zf.writestr(name, data)
+    except Exception as e:
+        logging.warning(f"寫入錄製檔案 {name} 失敗：{e}")
+
+
+def replay_fixtures(record_dir, save_to_db=True):
+    """重播錄製的封存檔：不啟動瀏覽器，直接解析卡片 HTML 並存入資料庫"""
+    archives = sorted(glob.glob(os.path.join(record_dir, "*.zip")))
+    logging.info(f"開始重播 {len(archives)} 個錄製檔案 ({record_dir})")
+
+    conn = connect_to_postgres() if save_to_db else None
+    if conn:
+        create_tables(conn)
+
+    results = {}
+    try:
+        for path in archives:
+            cid = os.path.splitext(os.path.basename(path))[0]
+            try:
+                with zipfile.ZipFile(path) as zf:
+                    names = set(zf.namelist())
+                    if "basic.html" not in names:
+                        logging.warning(f"錄製檔案 {path} 沒有基本資料，略過")
+                        continue
+                    basic = parse_basic_html(zf.read("basic.html").decode("utf-8"))
+                    grades = (
+                        parse_grade_html(zf.read("grade.html").decode("utf-8"))
+                        if "grade.html" in names
+                        else []
+                    )
+            except Exception as e:
+                logging.error(f"讀取錄製檔案 {path} 時發生錯誤：{e}")
+                continue
+
+            status = "success" if "grade.html" in names else "partial"
+            if conn:
+                save_data_to_postgres(conn, basic, grades, cid, status=status)
+            results[cid] = {"status": status, "basic": basic, "grades": grades}
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except:
+                logging.warning("關閉 PostgreSQL 連接時出錯")
+
+    logging.info(f"重播完成：{len(results)}/{len(archives)} 個公司")
+    return results
+
+
+def result_row_locator(cid):
+    """查詢結果列表中某公司的定位器：以級距按鈕的 kdbase_showPopGrade('<統一編號>') 連結識別，
+    不依賴列表是否顯示統一編號文字"""
+    By = selenium_api("By")
+    return By.CSS_SELECTOR, f"#listContainer a[href*=\"kdbase_showPopGrade('{cid}')\"]"
+
+
 def click_grade_button(driver, cid, max_retries=2):
     """點擊級距按鈕，帶有重試機制"""
+    By, WebDriverWait, EC = selenium_api("By", "WebDriverWait", "EC")
+
     for retry in range(max_retries + 1):
         try:
             # 等待背景遮罩消失
@@ -426,12 +1437,17 @@ def click_grade_button(driver, cid, max_retries=2):
                     return False
 
 
-def fetch_grade_separately(company_id: str, download_dir: str) -> list:
-    """使用單獨的 driver 獲取級距資料"""
-    driver2 = None
+def fetch_grade_separately(company_id: str, download_dir: str, record_dir=None, captcha_attempts=3) -> list:
+    """使用單獨的 driver 獲取級距資料
+
+    驗證碼嘗試次數用盡時拋出 CaptchaFailedError，其餘錯誤記錄後返回空列表。
+    """
+    By, WebDriverWait, EC = selenium_api("By", "WebDriverWait", "EC")
+
+    driver2 = None
     try:
         driver2 = setup_driver(download_dir)
-        driver2.get("https://fbfh.trade.gov.tw/fb/web/queryBasicf.do")
+        driver2.get(QUERY_URL)
         time.sleep(2)
 
         # 填寫統一編號
@@ -442,9 +1458,11 @@ def fetch_grade_separately(company_id: str, download_dir: str) -> list:
         id_input.send_keys(company_id)
 
         # 處理驗證碼
-        if not handle_captcha(driver2, "verifyCode", "realPic", "querySubmit"):
+        if not handle_captcha(
+            driver2, "verifyCode", "realPic", "querySubmit", company_id, captcha_attempts, record_dir=record_dir
+        ):
             logging.error(f"[fetch_grade] 驗證碼處理失敗")
-            return []
+            raise CaptchaFailedError(company_id)
 
         # 點擊級距按鈕
         if not click_grade_button(driver2, company_id):
@@ -455,9 +1473,11 @@ def fetch_grade_separately(company_id: str, download_dir: str) -> list:
         grades = extract_grade_data(driver2)
 
         # 存儲級距 PDF
+        card_html = driver2.find_element(By.ID, "popGradeCard").get_attribute("outerHTML")
+        record_fixture(record_dir, company_id, "grade.html", card_html)
         save_html_to_pdf(
             driver2,
-            driver2.find_element(By.ID, "popGradeCard").get_attribute("outerHTML"),
+            card_html,
             f"{download_dir}/{company_id}_實績級距.pdf",
             "廠商實績級距",
         )
@@ -466,20 +1486,40 @@ def fetch_grade_separately(company_id: str, download_dir: str) -> list:
         close_modal_dialog(driver2)
         return grades
 
+    except CaptchaFailedError:
+        raise
     except Exception as e:
         logging.error(f"[fetch_grade] 錯誤：{e}", exc_info=True)
         return []
     finally:
-        if driver2:
-            try:
-                driver2.quit()
-                logging.info("[fetch_grade] 第二隻 WebDriver 已關閉")
-            except:
-                logging.warning("[fetch_grade] 關閉第二隻 WebDriver 時出錯")
+        quit_driver(driver2, "[fetch_grade] 第二隻 WebDriver")
+
+
+# 預先組好的寫入語句 (欄位順序與 CompanyBasic / GradeRow 一致)
+_BASIC_COLUMNS = [f.name for f in fields(CompanyBasic)][1:]  # 統一編號另外傳入
+COMPANY_BASIC_UPSERT_SQL = (
+    f"INSERT INTO company_basic (company_id, fetch_date, status, {', '.join(_BASIC_COLUMNS)}) "
+    f"VALUES ({', '.join(['%s'] * (len(_BASIC_COLUMNS) + 3))}) "
+    "ON CONFLICT (company_id) DO UPDATE SET "
+    + ", ".join(f"{c}=EXCLUDED.{c}" for c in ["fetch_date", "status", *_BASIC_COLUMNS])
+)
+COMPANY_GRADE_UPSERT_SQL = (
+    "INSERT INTO company_grade "
+    "(company_id, year_ad, year_tw, year_month, import_grade, export_grade, fetch_date) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s) "
+    "ON CONFLICT (company_id, year_ad) DO UPDATE SET year_tw=EXCLUDED.year_tw, "
+    "year_month=EXCLUDED.year_month, import_grade=EXCLUDED.import_grade, "
+    "export_grade=EXCLUDED.export_grade, fetch_date=EXCLUDED.fetch_date"
+)
 
 
 def save_data_to_postgres(conn, basic, grades, cid, status="success"):
-    """將數據儲存到 PostgreSQL 資料庫"""
+    """將數據儲存到 PostgreSQL 資料庫
+
+    參數:
+        basic: CompanyBasic
+        grades: GradeRow 列表
+    """
     if not conn:
         logging.warning("無法保存資料：資料庫連接失敗")
         return False
@@ -487,92 +1527,30 @@ def save_data_to_postgres(conn, basic, grades, cid, status="success"):
     try:
         now = datetime.now()
         with conn.cursor() as cur:
-            # 基本資料
-            fields = []
-            values = []
-            params = []
-
-            # 映射數據
-            field_mapping = {
-                "統一編號": "company_id",
-                "核發日期": "issue_date",
-                "原始登記日期": "reg_date",
-                "廠商中文名稱": "cn_name",
-                "廠商英文名稱": "en_name",
-                "中文營業地址": "cn_address",
-                "英文營業地址": "en_address",
-                "代表人": "representative",
-                "電話號碼1": "tel1",
-                "電話號碼2": "tel2",
-                "傳真號碼": "fax",
-                "原中文名稱": "old_cn_name",
-                "原英文名稱": "old_en_name",
-                "網站": "website",
-                "電子信箱": "email",
-                "進口資格": "import_qualification",
-                "出口資格": "export_qualification",
-                "進口項目(中)": "import_items_cn",
-                "進口項目(英)": "import_items_en",
-                "出口項目(中)": "export_items_cn",
-                "出口項目(英)": "export_items_en",
-            }
-
-            # 添加基本字段
-            fields.append("company_id")
-            values.append("%s")
-            params.append(cid)
-
-            fields.append("fetch_date")
-            values.append("%s")
-            params.append(now)
-
-            fields.append("status")
-            values.append("%s")
-            params.append(status)
-
-            # 添加其他字段
-            for ch_field, en_field in field_mapping.items():
-                if ch_field in basic and ch_field != "統一編號":  # 統一編號已添加
-                    fields.append(en_field)
-                    values.append("%s")
-                    params.append(basic.get(ch_field, ""))
-
-            # 構建 SQL
-            sql = f"""
-            INSERT INTO company_basic ({', '.join(fields)})
-            VALUES ({', '.join(values)})
-            ON CONFLICT (company_id) DO UPDATE SET
-            """
+            # 基本資料 (統一編號以查詢用的 cid 為準)
+            cur.execute(COMPANY_BASIC_UPSERT_SQL, (cid, now, status, *basic.to_row()[1:]))
 
-            # 構建 UPDATE 部分
-            update_parts = []
-            for field in fields:
-                if field != "company_id":  # 主鍵不更新
-                    update_parts.append(f"{field}=EXCLUDED.{field}")
-
-            sql += ", ".join(update_parts)
-
-            # 執行 SQL
-            cur.execute(sql, params)
-
-            # 存級距資料
-            cur.execute("DELETE FROM company_grade WHERE company_id=%s", (cid,))
+            # 存級距資料 (以公司 + 西元年 upsert)
+            rows = []
             for g in grades:
-                cur.execute(
-                    """
-                INSERT INTO company_grade (company_id, year_month, year_tw, year_ad, import_grade, export_grade, fetch_date)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """,
+                if g.year_ad is None:
+                    logging.warning(f"級距資料缺少西元年，略過：{g}")
+                    continue
+                rows.append(
                     (
                         cid,
-                        g.get("年月", ""),
-                        g.get("民國年", ""),
-                        g.get("西元年", ""),
-                        g.get("進口級距", ""),
-                        g.get("出口級距", ""),
+                        g.year_ad,
+                        g.year_tw,
+                        g.year_month,
+                        grade_code(cur, g.import_grade),
+                        grade_code(cur, g.export_grade),
                         now,
-                    ),
+                    )
                 )
+            if rows:
+                if _grade_partitioned:
+                    ensure_grade_partitions(cur, {r[1] for r in rows})
+                cur.executemany(COMPANY_GRADE_UPSERT_SQL, rows)
 
         conn.commit()
         logging.info(f"已成功保存公司 {cid} 的資料到 PostgreSQL")
@@ -581,6 +1559,9 @@ def save_data_to_postgres(conn, basic, grades, cid, status="success"):
         logging.error(f"保存數據到 PostgreSQL 時發生錯誤：{e}")
         if conn:
             conn.rollback()
+        # 回滾後快取內的代碼或分區可能已不存在
+        _grade_codes.clear()
+        _grade_partitions.clear()
         return False
 
 
@@ -614,7 +1595,107 @@ def log_error_to_db(conn, company_id, error_message, stack_trace=""):
         if conn:
             conn.rollback()
 
-def handle_captcha(driver, input_id, captcha_id, submit_name, cid=None, max_attempts=3):
+
+def record_not_found(conn, company_id):
+    """將查無資料的統一編號寫入負面快取"""
+    if not conn:
+        return
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO company_not_found (company_id, checked_at) VALUES (%s, CURRENT_TIMESTAMP) "
+                "ON CONFLICT (company_id) DO UPDATE SET checked_at=CURRENT_TIMESTAMP, "
+                "hits=company_not_found.hits + 1",
+                (company_id[:10],),
+            )
+        conn.commit()
+        logging.info(f"已將公司 {company_id} 記錄為查無資料")
+    except Exception as e:
+        logging.error(f"記錄查無資料時發生錯誤：{e}")
+        conn.rollback()
+
+
+def cached_not_found_ids(conn, company_ids, ttl_days=NOT_FOUND_TTL_DAYS):
+    """返回在負面快取有效期內的統一編號集合"""
+    if not conn or not company_ids:
+        return set()
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT company_id FROM company_not_found "
+                "WHERE company_id = ANY(%s) AND checked_at > NOW() - make_interval(days => %s)",
+                (list(company_ids), ttl_days),
+            )
+            return {row[0] for row in cur.fetchall()}
+    except Exception as e:
+        logging.error(f"查詢負面快取時發生錯誤：{e}")
+        conn.rollback()
+        return set()
+
+
+def capture_and_recognize(driver, captcha_id, cid=None, record_dir=None):
+    """截取頁面上的驗證碼圖片並辨識
+
+    eager 載入策略下 driver.get 在 DOMContentLoaded 就返回，先等待驗證碼圖片載入完成再截圖。
+    """
+    from PIL import Image
+    By, WebDriverWait = selenium_api("By", "WebDriverWait")
+
+    WebDriverWait(driver, 10).until(
+        lambda d: d.execute_script(
+            "const img = document.getElementById(arguments[0]);"
+            "return !!img && img.complete && img.naturalWidth > 0;",
+            captcha_id,
+        )
+    )
+    profile_lap("query_page")
+    png = driver.find_element(By.ID, captcha_id).screenshot_as_png
+    record_fixture(record_dir, cid, "captcha/", png)
+    code = recognize_captcha(Image.open(io.BytesIO(png)))
+    profile_lap("captcha_ocr")
+    return code
+
+
+def prefetch_query(cid, download_dir="downloads", record_dir=None):
+    """預先開啟查詢頁面、填寫統一編號並辨識驗證碼，但不提交
+
+    供管線模式在背景執行緒使用，讓頁面載入與 OCR 和前一家公司的擷取、存庫重疊。
+    返回 {"driver": ..., "code": ...}，driver 交由 extract_company_data 負責關閉；
+    失敗時返回 None。
+    """
+    By, WebDriverWait, EC = selenium_api("By", "WebDriverWait", "EC")
+
+    driver = None
+    try:
+        start_recording(record_dir, cid)
+        driver = setup_driver(download_dir)
+        driver.get(QUERY_URL)
+        id_input = WebDriverWait(driver, 10).until(
+            EC.element_to_be_clickable((By.ID, "q_BanNo"))
+        )
+        id_input.clear()
+        id_input.send_keys(cid)
+        code = capture_and_recognize(driver, "realPic", cid, record_dir)
+        logging.info(f"[prefetch] 公司 {cid} 的驗證碼已預先辨識：{code}")
+        return {"driver": driver, "code": code}
+    except Exception as e:
+        logging.warning(f"[prefetch] 預先載入公司 {cid} 失敗：{e}")
+        quit_driver(driver, "[prefetch] WebDriver")
+        return None
+
+
+def handle_captcha(
+    driver,
+    input_id,
+    captcha_id,
+    submit_name,
+    cid=None,
+    max_attempts=3,
+    record_dir=None,
+    code=None,
+):
     """處理驗證碼識別與提交，支持3位數或4位數驗證碼
     
     參數:
@@ -624,13 +1705,18 @@ def handle_captcha(driver, input_id, captcha_id, submit_name, cid=None, max_atte
         submit_name: 提交按鈕的 name 屬性
         cid: 公司統一編號 (可選，用於重新填寫)
         max_attempts: 最大嘗試次數
+        record_dir: 錄製目錄 (可選，保存每張驗證碼圖片)
+        code: 預先辨識好的驗證碼 (可選，僅用於第一次嘗試，參見 prefetch_query)
+
+    查詢結果為「查無資料」時拋出 CompanyNotFoundError，不再重試。
     """
+    By, WebDriverWait, EC, TimeoutException = selenium_api("By", "WebDriverWait", "EC", "TimeoutException")
+
     for attempt in range(max_attempts):
         try:
-            # 截取驗證碼
-            pic = driver.find_element(By.ID, captcha_id)
-            img = Image.open(io.BytesIO(pic.screenshot_as_png))
-            code = recognize_captcha(img)
+            # 截取驗證碼 (第一次嘗試可使用預先辨識的結果)
+            if attempt > 0 or code is None:
+                code = capture_and_recognize(driver, captcha_id, cid, record_dir)
             logging.info(f"辨識的驗證碼（第 {attempt+1} 次）：{code}")
 
             # 輸入驗證碼
@@ -655,23 +1741,26 @@ def handle_captcha(driver, input_id, captcha_id, submit_name, cid=None, max_atte
                     error_present = True
                     logging.warning(f"查詢錯誤：{error_text}")
                     
-                    # 如果錯誤是查無資料，直接返回
+                    # 如果錯誤是查無資料，重試也沒有意義
                     if "查無資料" in error_text:
-                        return False
+                        raise CompanyNotFoundError(cid)
                     
                 except TimeoutException:
                     pass
 
-                # 沒有錯誤訊息，檢查是否有結果
+                # 沒有錯誤訊息，檢查是否有結果；會話重用時頁面上可能還留著上一家公司的
+                # 結果列表，因此要確認列表中已有本次查詢公司的結果列
                 if not error_present:
-                    WebDriverWait(driver, 10).until(
-                        EC.presence_of_element_located((By.ID, "listContainer"))
-                    )
+                    result_locator = result_row_locator(cid) if cid else (By.ID, "listContainer")
+                    WebDriverWait(driver, 10).until(EC.presence_of_element_located(result_locator))
                     logging.info("✅ 驗證碼認證成功，已獲得查詢結果")
                     return True
             except TimeoutException:
                 logging.warning("未找到結果容器，可能驗證碼錯誤")
 
+            if attempt == max_attempts - 1:
+                break
+
             # 驗證碼可能錯誤，刷新整個頁面
             driver.refresh()
             time.sleep(2)
@@ -687,6 +1776,8 @@ def handle_captcha(driver, input_id, captcha_id, submit_name, cid=None, max_atte
                 except:
                     logging.warning("重新填寫統一編號失敗")
 
+        except CompanyNotFoundError:
+            raise
         except Exception as e:
             if attempt < max_attempts - 1:
                 logging.warning(f"驗證碼嘗試 {attempt+1} 失敗：{e}")
@@ -707,49 +1798,427 @@ def handle_captcha(driver, input_id, captcha_id, submit_name, cid=None, max_atte
             else:
                 logging.error(f"驗證碼嘗試達到上限 ({max_attempts} 次)")
                 return False
-    
+
+    logging.error(f"驗證碼嘗試達到上限 ({max_attempts} 次)")
     return False
 
-def extract_company_data(cid: str, download_dir: str = "downloads", save_to_db: bool = True):
-    """處理單個公司資料的主函數"""
+
+class ScrapeSession:
+    """可重複使用的查詢會話
+
+    同一個瀏覽器頁面連續查詢多家公司：查完一家後直接在結果頁重新提交 q_BanNo 表單，
+    只有頁面要求時才解驗證碼。PDF 由另一隻 render 角色的 driver 輸出，
+    避免離開查詢結果頁面。
+    """
+
+    _counter = 0
+
+    def __init__(self, download_dir="downloads"):
+        ScrapeSession._counter += 1
+        self.session_id = ScrapeSession._counter
+        self.download_dir = download_dir
+        self.driver = setup_driver(download_dir)
+        self._render_driver = None
+        self.companies = 0
+        self.captchas = 0
+        self.page_loads = 0
+        self.needs_reload = True
+
+    def render_driver(self):
+        """延遲建立輸出 PDF 用的 driver"""
+        if self._render_driver is None:
+            self._render_driver = setup_driver(self.download_dir, role="render")
+        return self._render_driver
+
+    def recycle_reason(self):
+        """超過服務公司數或記憶體門檻時返回回收原因，否則返回 None"""
+        if self.companies >= DRIVER_MAX_COMPANIES:
+            return f"已服務 {self.companies} 家公司"
+        rss_mb = sum(WATCHDOG.rss_kb(d) for d in (self.driver, self._render_driver) if d) / 1024
+        if rss_mb >= DRIVER_MAX_RSS_MB:
+            return f"瀏覽器記憶體 {rss_mb:.0f} MB"
+        return None
+
+    def close(self):
+        """關閉會話的所有 driver 並記錄會話統計"""
+        for d in (self.driver, self._render_driver):
+            quit_driver(d, f"會話 #{self.session_id} 的 WebDriver")
+        self.driver = self._render_driver = None
+        logging.info(
+            f"會話 #{self.session_id} 結束：服務 {self.companies} 家公司，"
+            f"解驗證碼 {self.captchas} 次，載入頁面 {self.page_loads} 次"
+        )
+
+
+def submit_query(session, cid, record_dir=None, captcha_attempts=3):
+    """在會話的目前頁面提交統一編號查詢，只有頁面要求時才解驗證碼"""
+    By, WebDriverWait, EC, TimeoutException, NoSuchElementException = selenium_api(
+        "By", "WebDriverWait", "EC", "TimeoutException", "NoSuchElementException"
+    )
+
+    driver = session.driver
+
+    id_input = None
+    if not session.needs_reload:
+        try:
+            id_input = driver.find_element(By.ID, "q_BanNo")
+            if not id_input.is_displayed():
+                id_input = None
+        except NoSuchElementException:
+            id_input = None
+
+    # 頁面上沒有可用的查詢表單時才重新載入
+    if id_input is None:
+        driver.get(QUERY_URL)
+        session.page_loads += 1
+        session.needs_reload = False
+        id_input = WebDriverWait(driver, 10).until(
+            EC.element_to_be_clickable((By.ID, "q_BanNo"))
+        )
+    id_input.clear()
+    id_input.send_keys(cid)
+
+    try:
+        captcha_required = driver.find_element(By.ID, "realPic").is_displayed()
+    except NoSuchElementException:
+        captcha_required = False
+
+    if captcha_required:
+        session.captchas += 1
+        if not handle_captcha(
+            driver, "verifyCode", "realPic", "querySubmit", cid, captcha_attempts, record_dir=record_dir
+        ):
+            session.needs_reload = True
+            return False
+    else:
+        driver.find_element(By.NAME, "querySubmit").click()
+
+    # 結果頁面可能還留著上一家公司的列表，確認已出現本次查詢公司的結果列
+    try:
+        WebDriverWait(driver, 10).until(EC.presence_of_element_located(result_row_locator(cid)))
+        return True
+    except TimeoutException:
+        logging.warning(f"會話 #{session.session_id} 未取得公司 {cid} 的查詢結果")
+        session.needs_reload = True
+        return False
+
+
+def fetch_grade_in_session(session, cid, download_dir, record_dir=None, captcha_attempts=3):
+    """在會話的查詢結果頁面直接開啟級距卡片，失敗時改用單獨的 driver"""
+    By = selenium_api("By")
+
+    driver = session.driver
+    if not click_grade_button(driver, cid):
+        logging.warning("[session] 點擊級距按鈕失敗，改用單獨的 driver 獲取級距")
+        session.needs_reload = True
+        return fetch_grade_separately(cid, download_dir, record_dir, captcha_attempts)
+
+    grades = extract_grade_data(driver)
+    card_html = driver.find_element(By.ID, "popGradeCard").get_attribute("outerHTML")
+    record_fixture(record_dir, cid, "grade.html", card_html)
+    save_html_to_pdf(
+        session.render_driver(),
+        card_html,
+        f"{download_dir}/{cid}_實績級距.pdf",
+        "廠商實績級距",
+    )
+    if not close_modal_dialog(driver):
+        session.needs_reload = True
+    return grades
+
+
+class RunProfiler:
+    """--profile / --trace-webdriver 的執行期剖析
+
+    - 取樣剖析：背景執行緒定期以 sys._current_frames() 取樣所有執行緒的呼叫堆疊，
+      輸出 flamegraph.pl / speedscope 可讀取的 folded stacks
+    - 分段計時：每家公司一筆 JSONL，記錄總耗時與各階段 (profile_lap) 耗時
+    - WebDriver 指令追蹤：統計每種 WebDriver 指令的次數與耗時
+    """
+
+    def __init__(self, output_dir=None, trace_webdriver=False, interval=0.005):
+        self.output_dir = output_dir
+        self.trace_webdriver = trace_webdriver
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stacks = {}  # folded stack -> 取樣次數
+        self.samples = 0
+        self.commands = {}  # WebDriver 指令 -> [次數, 秒數]
+        self.stage_totals = {}  # 階段 -> 秒數
+        self.companies = 0
+        self._stop = threading.Event()
+        self._sampler = None
+        self._restore_execute = None
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.folded_path = self.timings_path = None
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+            self.folded_path = os.path.join(output_dir, f"profile-{stamp}.folded")
+            self.timings_path = os.path.join(output_dir, f"timings-{stamp}.jsonl")
+
+    def start(self):
+        if self.trace_webdriver:
+            self._install_webdriver_trace()
+        if self.output_dir:
+            self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+            self._sampler.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        if self._restore_execute:
+            self._restore_execute()
+        if self.folded_path:
+            with open(self.folded_path, "w", encoding="utf-8") as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            logging.info(f"取樣剖析 {self.samples} 次，已寫入 {self.folded_path}")
+        self.log_summary()
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack)).replace(" ", "_")
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def _install_webdriver_trace(self):
+        """以包裝 WebDriver.execute 的方式統計每個指令 (WebElement 的指令同樣經過這裡)"""
+        WebDriver = selenium_api("WebDriver")
+
+        original = WebDriver.execute
+        profiler = self
+
+        @functools.wraps(original)
+        def execute(driver, driver_command, params=None):
+            t0 = time.perf_counter()
+            try:
+                return original(driver, driver_command, params)
+            finally:
+                profiler.count_command(driver_command, time.perf_counter() - t0)
+
+        WebDriver.execute = execute
+        self._restore_execute = lambda: setattr(WebDriver, "execute", original)
+
+    def count_command(self, command, elapsed):
+        with self.lock:
+            total = self.commands.setdefault(command, [0, 0.0])
+            total[0] += 1
+            total[1] += elapsed
+        record = getattr(self.local, "record", None)
+        if record is not None:
+            entry = record["webdriver"].setdefault(command, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def begin(self, cid):
+        now = time.perf_counter()
+        self.local.record = {"company_id": cid, "start": now, "last": now, "stages": {}, "webdriver": {}}
+
+    def lap(self, stage):
+        """將上一個計時點到現在的時間計入 stage"""
+        record = getattr(self.local, "record", None)
+        if record is None:
+            return
+        now = time.perf_counter()
+        record["stages"][stage] = record["stages"].get(stage, 0.0) + now - record["last"]
+        record["last"] = now
+
+    def end(self, result):
+        self.lap("other")
+        record = self.local.record
+        self.local.record = None
+        line = {
+            "company_id": record["company_id"],
+            "status": result["status"] if result else "error",
+            "wall": round(time.perf_counter() - record["start"], 4),
+            "stages": {k: round(v, 4) for k, v in record["stages"].items()},
+            "webdriver": {k: {"count": n, "seconds": round(t, 4)} for k, (n, t) in record["webdriver"].items()},
+        }
+        with self.lock:
+            self.companies += 1
+            for stage, secs in record["stages"].items():
+                self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + secs
+            if self.timings_path:
+                with open(self.timings_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    def log_summary(self, top=15):
+        if self.companies:
+            total = sum(self.stage_totals.values()) or 1
+            logging.info(f"===== 各階段耗時 ({self.companies} 家公司) =====")
+            for stage, secs in sorted(self.stage_totals.items(), key=lambda x: -x[1]):
+                logging.info(f"{stage:>14}: {secs:8.2f}s ({secs / total:5.1%})，平均 {secs / self.companies:.2f}s")
+            if self.timings_path:
+                logging.info(f"分段計時已寫入 {self.timings_path}")
+        if self.commands:
+            logging.info(f"===== WebDriver 指令 (前 {top} 名，依耗時排序) =====")
+            for cmd, (n, secs) in sorted(self.commands.items(), key=lambda x: -x[1][1])[:top]:
+                logging.info(f"{cmd:>24}: {n:5d} 次，共 {secs:7.2f}s，平均 {secs / n * 1000:.1f}ms")
+
+
+# 目前的剖析器 (未啟用時為 None，profile_lap 等呼叫不做任何事)
+PROFILER = None
+
+
+def start_profiling(output_dir=None, trace_webdriver=False):
+    """啟用全域剖析器並返回；兩者都未指定時返回 None"""
+    global PROFILER
+    if not output_dir and not trace_webdriver:
+        return None
+    PROFILER = RunProfiler(output_dir, trace_webdriver).start()
+    return PROFILER
+
+
+def stop_profiling():
+    global PROFILER
+    if PROFILER:
+        PROFILER.stop()
+        PROFILER = None
+
+
+def profile_lap(stage):
+    """記錄目前公司的分段計時點 (未啟用剖析時不做任何事)"""
+    if PROFILER:
+        PROFILER.lap(stage)
+
+
+def profiled_company(func):
+    """為每次 extract_company_data 呼叫建立一筆分段計時記錄"""
+
+    @functools.wraps(func)
+    def wrapper(cid, *args, **kwargs):
+        if PROFILER is None:
+            return func(cid, *args, **kwargs)
+        profiler = PROFILER
+        profiler.begin(cid)
+        result = None
+        try:
+            result = func(cid, *args, **kwargs)
+            return result
+        finally:
+            profiler.end(result)
+
+    return wrapper
+
+
+@profiled_company
+def extract_company_data(
+    cid: str,
+    download_dir: str = "downloads",
+    save_to_db: bool = True,
+    record_dir=None,
+    max_page_attempts: int = 3,
+    session=None,
+    prefetched=None,
+    captcha_attempts: int = 3,
+):
+    """處理單個公司資料的主函數
+
+    參數:
+        record_dir: 錄製目錄 (可選)，將卡片 HTML 與驗證碼圖片保存到 <record_dir>/<cid>.zip
+        max_page_attempts: 查詢頁面最大嘗試次數 (批次模式由 RetryScheduler 接手重試，設為 1)
+        captcha_attempts: 每次查詢 (含級距) 的驗證碼嘗試次數，每次失敗都會重新載入頁面
+                          (批次/節點模式設為 1，只以 RETRY_POLICIES 的 captcha 預算重試)
+        session: ScrapeSession (可選)，提供時沿用其瀏覽器頁面，不會關閉 driver
+        prefetched: prefetch_query 的結果 (可選)，沿用已載入的頁面與預先辨識的驗證碼
+
+    返回:
+        dict: status (success/partial/error/not_found)、basic (CompanyBasic 或 None)、
+              grades (GradeRow 列表)，以及失敗類別 failure
+              (參見 RETRY_POLICIES，成功時為 None)
+    """
+    By, WebDriverWait, EC = selenium_api("By", "WebDriverWait", "EC")
+
     os.makedirs(download_dir, exist_ok=True)
+    if not prefetched:
+        start_recording(record_dir, cid)
     conn = connect_to_postgres() if save_to_db else None
     if conn:
         create_tables(conn)
 
     driver = None
-    basic, grades = {}, []
+    basic, grades = None, []
     error_occurred = False
     error_message = ""
+    failure = None
 
     logging.info(f"========== 開始爬取公司 {cid} 的資料 ==========")
 
     try:
-        driver = setup_driver(download_dir)
+        if session:
+            driver = session.driver
+        elif prefetched:
+            driver = prefetched["driver"]
+        else:
+            driver = setup_driver(download_dir)
+        if driver is None:
+            failure = "driver_crash"
+            if conn:
+                log_error_to_db(conn, cid, "初始化 WebDriver 失敗")
+            return {"status": "error", "basic": basic, "grades": grades, "failure": failure}
+        profile_lap("driver_setup")
 
         # --- 驗證碼 + 查詢 + 取基本資料 ---
         success = False
-        max_page_attempts = 3
-        
+
         for page_attempt in range(max_page_attempts):
             try:
-                # 訪問查詢頁面
-                driver.get("https://fbfh.trade.gov.tw/fb/web/queryBasicf.do")
-                time.sleep(2)
+                if session:
+                    if submit_query(session, cid, record_dir, captcha_attempts):
+                        success = True
+                        break
+                    failure = "captcha"
+                    continue
+
+                # 預先載入的頁面已填好統一編號並辨識驗證碼
+                code = prefetched["code"] if prefetched and page_attempt == 0 else None
+                if code is None:
+                    # 訪問查詢頁面
+                    driver.get(QUERY_URL)
+                    time.sleep(2)
+
+                    # 填寫統一編號
+                    id_input = WebDriverWait(driver, 10).until(
+                        EC.element_to_be_clickable((By.ID, "q_BanNo"))
+                    )
+                    id_input.clear()
+                    id_input.send_keys(cid)
 
-                # 填寫統一編號
-                id_input = WebDriverWait(driver, 10).until(
-                    EC.element_to_be_clickable((By.ID, "q_BanNo"))
-                )
-                id_input.clear()
-                id_input.send_keys(cid)
-                
                 # 處理驗證碼
-                if handle_captcha(driver, "verifyCode", "realPic", "querySubmit"):
+                if handle_captcha(
+                    driver,
+                    "verifyCode",
+                    "realPic",
+                    "querySubmit",
+                    cid,
+                    max_attempts=captcha_attempts,
+                    record_dir=record_dir,
+                    code=code,
+                ):
                     success = True
                     break
-                
+                failure = "captcha"
+
+            except CompanyNotFoundError:
+                raise
             except Exception as e:
+                failure = classify_failure(e)
+                if session:
+                    session.needs_reload = True
                 if page_attempt < max_page_attempts - 1:
                     logging.warning(f"頁面處理第 {page_attempt+1} 次失敗：{e}，將重試")
                     time.sleep(3)
@@ -760,9 +2229,11 @@ def extract_company_data(cid: str, download_dir: str = "downloads", save_to_db:
 
         if not success:
             if conn:
-                log_error_to_db(conn, cid, "驗證碼處理失敗或查詢無結果")
+                log_error_to_db(conn, cid, error_message or "驗證碼處理失敗或查詢無結果")
             logging.error(f"無法繼續爬取公司 {cid} 的資料：驗證碼處理失敗")
-            return
+            return {"status": "error", "basic": basic, "grades": grades, "failure": failure}
+        failure = None
+        profile_lap("query_submit")
 
         # 點擊基本資料按鈕
         try:
@@ -776,40 +2247,67 @@ def extract_company_data(cid: str, download_dir: str = "downloads", save_to_db:
                 EC.visibility_of_element_located((By.ID, "popBasicCard"))
             )
             basic = extract_basic_data(driver)
+            profile_lap("basic_extract")
 
             # 保存基本資料 PDF
+            card_html = driver.find_element(By.ID, "popBasicCard").get_attribute("outerHTML")
+            record_fixture(record_dir, cid, "basic.html", card_html)
             save_html_to_pdf(
-                driver,
-                driver.find_element(By.ID, "popBasicCard").get_attribute("outerHTML"),
+                session.render_driver() if session else driver,
+                card_html,
                 f"{download_dir}/{cid}_基本資料.pdf",
                 "廠商基本資料",
             )
+            profile_lap("basic_pdf")
 
             # 關閉模態對話框
-            close_modal_dialog(driver)
+            if not close_modal_dialog(driver) and session:
+                session.needs_reload = True
         except Exception as e:
+            if session:
+                session.needs_reload = True
             logging.error(f"獲取基本資料時發生錯誤：{e}")
             error_message = f"獲取基本資料失敗：{str(e)}"
             error_occurred = True
+            failure = classify_failure(e)
 
-        # --- 實績級距：使用第二隻 driver ---
+        # --- 實績級距：會話模式沿用同一頁面，否則使用第二隻 driver ---
         try:
-            grades = fetch_grade_separately(cid, download_dir)
+            if session and not session.needs_reload:
+                grades = fetch_grade_in_session(session, cid, download_dir, record_dir, captcha_attempts)
+            else:
+                grades = fetch_grade_separately(cid, download_dir, record_dir, captcha_attempts)
         except Exception as e:
             logging.error(f"獲取級距資料時發生錯誤：{e}")
             error_message = f"獲取級距資料失敗：{str(e)}"
             error_occurred = True
+            # 級距未取得也要交給重試排程器，否則會被當成成功而遺失級距資料
+            failure = failure or classify_failure(e)
+        profile_lap("grades")
 
         # --- 存庫 ---
+        status = "partial" if error_occurred else "success"
         if conn:
             if error_occurred:
                 log_error_to_db(conn, cid, error_message)
-                # 仍然保存已獲取的資料
-                if basic:
-                    save_data_to_postgres(conn, basic, grades, cid, status="partial")
-            else:
-                save_data_to_postgres(conn, basic, grades, cid)
-
+            # 仍然保存已獲取的資料
+            if (basic or not error_occurred) and not save_data_to_postgres(
+                conn, basic, grades, cid, status=status
+            ):
+                failure = "db_error"
+            profile_lap("db_save")
+        if not basic:
+            status = "error"
+
+        return {"status": status, "basic": basic, "grades": grades, "failure": failure}
+
+    except CompanyNotFoundError:
+        if session:
+            # 頁面上的「查無資料」提示會影響下一次查詢的判斷
+            session.needs_reload = True
+        logging.warning(f"公司 {cid} 查無資料，不再重試")
+        record_not_found(conn, cid)
+        return {"status": "not_found", "basic": basic, "grades": grades, "failure": "not_found"}
     except Exception as e:
         error_message = f"爬取過程中發生錯誤：{str(e)}"
         logging.error(f"[主流程] 錯誤：{e}", exc_info=True)
@@ -818,13 +2316,17 @@ def extract_company_data(cid: str, download_dir: str = "downloads", save_to_db:
 
             stack_trace = traceback.format_exc()
             log_error_to_db(conn, cid, error_message, stack_trace)
+        return {
+            "status": "error",
+            "basic": basic,
+            "grades": grades,
+            "failure": classify_failure(e),
+        }
     finally:
-        if driver:
-            try:
-                driver.quit()
-                logging.info("主 WebDriver 已關閉")
-            except:
-                logging.warning("關閉主 WebDriver 時出錯")
+        if session:
+            session.companies += 1
+        else:
+            quit_driver(driver, "主 WebDriver")
 
         if conn:
             try:
@@ -836,50 +2338,1168 @@ def extract_company_data(cid: str, download_dir: str = "downloads", save_to_db:
         logging.info(f"========== 完成爬取公司 {cid} 的資料 ==========\n")
 
 
-def batch_process(company_ids, download_dir="downloads", save_to_db=True):
-    """批次處理多個公司的資料"""
+# 失敗類別與重試策略
+#   max_retries: 該類失敗最多重新排程幾次
+#   base_delay / max_delay: 指數退避的起始與上限秒數
+RETRY_POLICIES = {
+    "captcha": {"max_retries": 2, "base_delay": 5, "max_delay": 60},
+    "not_found": {"max_retries": 0, "base_delay": 0, "max_delay": 0},
+    "timeout": {"max_retries": 2, "base_delay": 15, "max_delay": 120},
+    "driver_crash": {"max_retries": 2, "base_delay": 10, "max_delay": 60},
+    "db_error": {"max_retries": 3, "base_delay": 5, "max_delay": 60},
+    "other": {"max_retries": 1, "base_delay": 10, "max_delay": 60},
+}
+
+
+def retry_delay(policy, n):
+    """第 n 次失敗後的退避秒數 (指數成長、有上限，加上 ±20% 抖動)"""
+    delay = min(policy["base_delay"] * 2 ** (n - 1), policy["max_delay"])
+    return delay * random.uniform(0.8, 1.2)
+
+
+# 瀏覽器已無法使用時 WebDriverException 訊息中會出現的片段
+DRIVER_CRASH_MESSAGES = ("chrome not reachable", "disconnected", "session deleted", "tab crashed")
+
+
+def classify_failure(error) -> str:
+    """依例外類型判斷失敗類別 (RETRY_POLICIES 的鍵)
+
+    只有瀏覽器確實失效 (會話無效、視窗消失、無法連線) 才算 driver_crash；
+    找不到元素、元素過期等頁面層級的錯誤歸為 other，不消耗 driver_crash 預算也不會重建會話。
+    """
+    import psycopg2
+    TimeoutException, WebDriverException, InvalidSessionIdException, NoSuchWindowException = selenium_api(
+        "TimeoutException", "WebDriverException", "InvalidSessionIdException", "NoSuchWindowException"
+    )
+
+    if isinstance(error, CaptchaFailedError):
+        return "captcha"
+    if isinstance(error, TimeoutException):
+        return "timeout"
+    if isinstance(error, psycopg2.Error):
+        return "db_error"
+    if isinstance(error, (InvalidSessionIdException, NoSuchWindowException)):
+        return "driver_crash"
+    if isinstance(error, WebDriverException):
+        message = (error.msg or "").lower()
+        if any(m in message for m in DRIVER_CRASH_MESSAGES):
+            return "driver_crash"
+    return "other"
+
+
+class RetryScheduler:
+    """批次重試排程器
+
+    每家公司依失敗類別各自計算重試預算；可重試的公司以指數退避重新排到佇列尾端，
+    不會阻塞其他公司的處理。
+    """
+
+    def __init__(self, company_ids, policies=None):
+        self.policies = policies or RETRY_POLICIES
+        self.queue = deque((cid, 0.0) for cid in company_ids)
+        self.failures = {}  # cid -> {失敗類別: 次數}
+        self.retries = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def next(self, wait=True):
+        """取出下一個可執行的公司；若全部都在退避中，則等待最早到期的一個
+
+        wait 為 False 時不等待，沒有可立即執行的公司就返回 None。
+        """
+        if not self.queue:
+            return None
+
+        now = time.monotonic()
+        for _ in range(len(self.queue)):
+            cid, ready_at = self.queue[0]
+            if ready_at <= now:
+                self.queue.popleft()
+                return cid
+            self.queue.rotate(-1)
+
+        if not wait:
+            return None
+        item = min(self.queue, key=lambda x: x[1])
+        self.queue.remove(item)
+        wait = item[1] - time.monotonic()
+        if wait > 0:
+            logging.info(f"所有待重試公司仍在退避中，等待 {wait:.1f} 秒")
+            time.sleep(wait)
+        return item[0]
+
+    def record_failure(self, cid, failure) -> bool:
+        """記錄一次失敗，預算未用完時重新排入佇列，返回是否已重新排程"""
+        policy = self.policies.get(failure, self.policies["other"])
+        counts = self.failures.setdefault(cid, {})
+        counts[failure] = counts.get(failure, 0) + 1
+        n = counts[failure]
+
+        if n > policy["max_retries"]:
+            logging.warning(f"公司 {cid} 的 {failure} 失敗已達上限 ({policy['max_retries']} 次重試)")
+            return False
+
+        delay = retry_delay(policy, n)
+        self.queue.append((cid, time.monotonic() + delay))
+        self.retries += 1
+        logging.info(f"公司 {cid} 發生 {failure} 失敗 (第 {n} 次)，{delay:.1f} 秒後重試")
+        return True
+
+
+def batch_process(
+    company_ids,
+    download_dir="downloads",
+    save_to_db=True,
+    record_dir=None,
+    reuse_session=False,
+    pipeline=False,
+):
+    """批次處理多個公司的資料，失敗的公司交由 RetryScheduler 重新排程
+
+    reuse_session 為 True 時以 ScrapeSession 連續查詢，WebDriver 異常時才重建會話。
+    pipeline 為 True 時，處理目前公司的同時在背景執行緒以 prefetch_query
+    預先載入下一家公司的查詢頁面並辨識驗證碼 (與 reuse_session 互斥)。
+
+    返回:
+        dict: 統一編號 -> extract_company_data 的最後一次結果
+    """
     success_count = 0
     error_count = 0
     skipped_count = 0
+    not_found_count = 0
+    results = {}
 
     total = len(company_ids)
     logging.info(f"開始批次處理 {total} 個公司")
+    WATCHDOG.start()
 
-    for i, cid in enumerate(company_ids, 1):
+    # 略過負面快取中仍在有效期內的「查無資料」統一編號，不必啟動瀏覽器
+    if save_to_db:
+        conn = connect_to_postgres()
+        if conn:
+            create_tables(conn)
+            cached = cached_not_found_ids(conn, company_ids)
+            conn.close()
+            if cached:
+                logging.info(f"負面快取略過 {len(cached)} 個查無資料的公司：{sorted(cached)}")
+                for cid in cached:
+                    results[cid] = {"status": "not_found", "basic": None, "grades": [], "failure": "not_found"}
+                company_ids = [cid for cid in company_ids if cid not in cached]
+                skipped_count = len(cached)
+
+    scheduler = RetryScheduler(company_ids)
+    session = None
+    if pipeline and reuse_session:
+        logging.warning("管線模式與會話重用模式不能同時使用，將只使用會話重用模式")
+        pipeline = False
+    executor = ThreadPoolExecutor(max_workers=1) if pipeline else None
+    pending = None  # (統一編號, 預先載入的 Future)
+
+    i = 0
+    while len(scheduler) or pending:
+        if pending:
+            cid, future = pending
+            pending = None
+        else:
+            cid = scheduler.next()
+            future = executor.submit(prefetch_query, cid, download_dir, record_dir) if executor else None
+        i += 1
         try:
-            logging.info(f"正在處理第 {i}/{total} 個公司 (統編: {cid})")
-            extract_company_data(cid, download_dir, save_to_db)
-            success_count += 1
+            logging.info(f"正在處理第 {i} 次任務 (統編: {cid}，剩餘 {len(scheduler)} 個)")
+            if reuse_session and session is None:
+                session = ScrapeSession(download_dir)
+            prefetched = future.result() if future else None
+
+            # 先在背景預先載入下一家公司，再處理目前的公司
+            if executor:
+                nxt = scheduler.next(wait=False)
+                if nxt:
+                    pending = (nxt, executor.submit(prefetch_query, nxt, download_dir, record_dir))
+
+            result = extract_company_data(
+                cid,
+                download_dir,
+                save_to_db,
+                record_dir,
+                max_page_attempts=1,
+                session=session,
+                prefetched=prefetched,
+                captcha_attempts=1,
+            )
         except Exception as e:
             logging.error(f"處理公司 {cid} 時發生未捕獲的異常：{e}", exc_info=True)
+            result = {"status": "error", "basic": None, "grades": [], "failure": classify_failure(e)}
+
+        if session:
+            reason = "WebDriver 異常" if result["failure"] == "driver_crash" else session.recycle_reason()
+            if reason:
+                logging.info(f"重建會話 #{session.session_id}：{reason}")
+                WATCHDOG.recycled += 1
+                session.close()
+                session = None
+
+        results[cid] = result
+        if not result["failure"]:
+            success_count += 1
+        elif result["failure"] == "not_found":
+            not_found_count += 1
+        elif not scheduler.record_failure(cid, result["failure"]):
             error_count += 1
 
         # 每處理 3 個公司暫停一下，避免被網站檢測為機器人
-        if i % 3 == 0 and i < total:
+        if i % 3 == 0 and len(scheduler):
             pause_time = random.randint(5, 15)
-            logging.info(f"已處理 {i} 個公司，暫停 {pause_time} 秒...")
+            logging.info(f"已處理 {i} 次任務，暫停 {pause_time} 秒...")
             time.sleep(pause_time)
 
+    if session:
+        session.close()
+    if executor:
+        executor.shutdown()
+    WATCHDOG.sweep()
+    gauges = WATCHDOG.gauges()
+
     logging.info(
         f"""
     ===== 批次處理結果 =====
     總計: {total} 個公司
     成功: {success_count} 個
     錯誤: {error_count} 個
-    跳過: {skipped_count} 個
+    查無資料: {not_found_count} 個
+    跳過: {skipped_count} 個 (負面快取)
+    重試: {scheduler.retries} 次
+    靜態資源快取: 命中 {CACHE_STATS['hits']} / 未命中 {CACHE_STATS['misses']}
+    瀏覽器行程: 殘留 {gauges['browser_processes']} 個，重建 driver {gauges['drivers_recycled']} 次，清除孤兒 {gauges['orphans_killed']} 個
+    """
+    )
+    return results
+
+
+# 多節點分散爬取
+#   NODE_RATE_PER_MINUTE: 每個節點每分鐘最多爬取的公司數 (各節點有各自的出口 IP，各自計算)
+#   NODE_HEARTBEAT_INTERVAL: 心跳間隔秒數
+#   NODE_TIMEOUT: 超過此秒數沒有心跳的節點視為離線，其負責的區段由其他節點接手
+NODE_RATE_PER_MINUTE = float(os.environ.get("NODE_RATE_PER_MINUTE", "4"))
+NODE_HEARTBEAT_INTERVAL = int(os.environ.get("NODE_HEARTBEAT_INTERVAL", "10"))
+NODE_TIMEOUT = int(os.environ.get("NODE_TIMEOUT", "45"))
+RING_MAX = 2**63 - 1
+
+
+def ring_hash(key) -> int:
+    """一致性雜湊值 (0 ~ 2^63-1，可直接存入 BIGINT 欄位)"""
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big") >> 1
+
+
+class HashRing:
+    """一致性雜湊環
+
+    每個節點在環上放置 vnodes 個虛擬節點，統一編號歸屬於順時針方向的第一個虛擬節點。
+    節點加入或離線時，只有相鄰區段的統一編號會換手。
+    """
+
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = sorted(nodes)
+        self.ring = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+
+    def ranges(self, node):
+        """返回 node 負責的雜湊區段 [(下界 (不含), 上界 (含)), ...]"""
+        result = []
+        for i, (h, owner) in enumerate(self.ring):
+            if owner != node:
+                continue
+            if i == 0:
+                # 第一個虛擬節點同時負責環尾 (最後一個虛擬節點之後) 的區段
+                result.append((self.ring[-1][0], RING_MAX))
+                result.append((-1, h))
+            else:
+                result.append((self.ring[i - 1][0], h))
+        return result
+
+
+class TokenBucket:
+    """節點的速率預算：每分鐘補充 rate_per_minute 個權杖，最多累積 burst 個"""
+
+    def __init__(self, rate_per_minute, burst=1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        """取得一個權杖，不足時等待"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+def create_node_tables(conn):
+    """建立節點註冊表與工作佇列表"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+        CREATE TABLE IF NOT EXISTS scrape_nodes (
+            node_id VARCHAR(100) PRIMARY KEY,
+            hostname VARCHAR(255),
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_heartbeat TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            rate_per_minute REAL,
+            completed INTEGER DEFAULT 0
+        )"""
+        )
+        cur.execute(
+            """
+        CREATE TABLE IF NOT EXISTS scrape_jobs (
+            company_id VARCHAR(10) PRIMARY KEY,
+            ring_hash BIGINT NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            node_id VARCHAR(100),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            failure VARCHAR(20),
+            failure_counts JSONB NOT NULL DEFAULT '{}',
+            ready_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )"""
+        )
+        # 各失敗類別的次數 (與 RetryScheduler 相同，依類別各自計算重試預算)
+        cur.execute("ALTER TABLE scrape_jobs ADD COLUMN IF NOT EXISTS failure_counts JSONB NOT NULL DEFAULT '{}'")
+        cur.execute("CREATE INDEX IF NOT EXISTS scrape_jobs_pending_idx ON scrape_jobs (ring_hash) WHERE status = 'pending'")
+    conn.commit()
+
+
+def enqueue_companies(conn, company_ids):
+    """將統一編號加入工作佇列 (已存在的不變)；負面快取中的統一編號直接標記為完成"""
+    cached = cached_not_found_ids(conn, company_ids)
+    with conn.cursor() as cur:
+        cur.executemany(
+            "INSERT INTO scrape_jobs (company_id, ring_hash, status, failure) VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT (company_id) DO NOTHING",
+            [
+                (cid, ring_hash(cid), "done", "not_found") if cid in cached else (cid, ring_hash(cid), "pending", None)
+                for cid in company_ids
+            ],
+        )
+    conn.commit()
+    logging.info(f"已加入 {len(company_ids)} 個統一編號到工作佇列 (負面快取略過 {len(cached)} 個)")
+
+
+class ScrapeNode:
+    """分散爬取節點
+
+    各節點透過 PostgreSQL 協調，不需要中央協調程序：
+    - 心跳執行緒定期更新 scrape_nodes；超過 NODE_TIMEOUT 沒有心跳的節點視為離線
+    - 依目前存活的節點建立一致性雜湊環，每個節點只認領自己區段內的待處理公司
+    - 離線節點認領中 (running) 的公司退回待處理，其區段自動由環上的下一個節點接手
+    - 認領以 FOR UPDATE SKIP LOCKED 進行，同一時間只有一個節點持有工作；但心跳中斷的節點
+      被退回的工作可能由其他節點重新爬取 (至少一次)，結果只由目前的認領者寫入工作佇列
+    - 心跳無法連線或持續失敗時暫停認領，避免其他節點接手區段後重複爬取
+    """
+
+    def __init__(
+        self,
+        node_id,
+        download_dir="downloads",
+        record_dir=None,
+        rate_per_minute=NODE_RATE_PER_MINUTE,
+        burst=1,
+        vnodes=64,
+        heartbeat_interval=NODE_HEARTBEAT_INTERVAL,
+        node_timeout=NODE_TIMEOUT,
+    ):
+        self.node_id = node_id
+        self.download_dir = download_dir
+        self.record_dir = record_dir
+        self.rate_per_minute = rate_per_minute
+        self.bucket = TokenBucket(rate_per_minute, burst)
+        self.vnodes = vnodes
+        self.heartbeat_interval = heartbeat_interval
+        self.node_timeout = node_timeout
+        self.ring = None
+        self.completed = 0
+        self.last_heartbeat = time.monotonic()
+        self._stop = threading.Event()
+
+    def _heartbeat_loop(self, conn):
+        # 使用獨立連線，爬取單一公司耗時較久也不會被誤判為離線；連線中斷時重新連線
+        try:
+            while not self._stop.wait(self.heartbeat_interval):
+                if conn is None:
+                    conn = connect_to_postgres()
+                    if conn is None:
+                        continue
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            "UPDATE scrape_nodes SET last_heartbeat = CURRENT_TIMESTAMP, completed = %s WHERE node_id = %s",
+                            (self.completed, self.node_id),
+                        )
+                    conn.commit()
+                    self.last_heartbeat = time.monotonic()
+                except Exception as e:
+                    logging.warning(f"[node {self.node_id}] 心跳失敗：{e}")
+                    if conn.closed:
+                        conn = None
+                    else:
+                        conn.rollback()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def heartbeat_stale(self):
+        """心跳是否即將逾時 (再錯過一次心跳，其他節點就會視本節點為離線)"""
+        return time.monotonic() - self.last_heartbeat > self.node_timeout - self.heartbeat_interval
+
+    def register(self, conn):
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO scrape_nodes (node_id, hostname, rate_per_minute) VALUES (%s, %s, %s) "
+                "ON CONFLICT (node_id) DO UPDATE SET hostname = EXCLUDED.hostname, "
+                "rate_per_minute = EXCLUDED.rate_per_minute, started_at = CURRENT_TIMESTAMP, "
+                "last_heartbeat = CURRENT_TIMESTAMP, completed = 0",
+                (self.node_id, socket.gethostname(), self.rate_per_minute),
+            )
+            # 清除一天以上沒有心跳的節點記錄
+            cur.execute("DELETE FROM scrape_nodes WHERE last_heartbeat < CURRENT_TIMESTAMP - INTERVAL '1 day'")
+            # 同一節點重新啟動時，上次未完成的公司退回待處理
+            cur.execute(
+                "UPDATE scrape_jobs SET status = 'pending', node_id = NULL WHERE status = 'running' AND node_id = %s",
+                (self.node_id,),
+            )
+        conn.commit()
+
+    def leave(self, conn):
+        """正常離開：刪除節點記錄並退回認領中的公司，區段立即由其他節點接手"""
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE scrape_jobs SET status = 'pending', node_id = NULL WHERE status = 'running' AND node_id = %s",
+                (self.node_id,),
+            )
+            cur.execute("DELETE FROM scrape_nodes WHERE node_id = %s", (self.node_id,))
+        conn.commit()
+
+    def refresh_ring(self, conn):
+        """依存活節點重建雜湊環，並退回離線節點認領中的公司"""
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT node_id FROM scrape_nodes "
+                "WHERE last_heartbeat > CURRENT_TIMESTAMP - %s * INTERVAL '1 second'",
+                (self.node_timeout,),
+            )
+            live = [row[0] for row in cur.fetchall()]
+            if self.node_id not in live:
+                live.append(self.node_id)
+            cur.execute(
+                "UPDATE scrape_jobs SET status = 'pending', node_id = NULL "
+                "WHERE status = 'running' AND NOT (node_id = ANY(%s)) RETURNING company_id",
+                (live,),
+            )
+            released = [row[0] for row in cur.fetchall()]
+        conn.commit()
+        if released:
+            logging.warning(f"[node {self.node_id}] 離線節點的 {len(released)} 個公司已退回待處理：{released}")
+        if self.ring is None or self.ring.nodes != sorted(live):
+            self.ring = HashRing(live, self.vnodes)
+            logging.info(f"[node {self.node_id}] 節點成員：{self.ring.nodes}")
+
+    def claim(self, conn):
+        """認領一個屬於本節點區段、已到重試時間的待處理公司"""
+        ranges = self.ring.ranges(self.node_id)
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+            UPDATE scrape_jobs SET status = 'running', node_id = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE company_id = (
+                SELECT j.company_id FROM scrape_jobs j
+                JOIN unnest(%s::bigint[], %s::bigint[]) AS r(lo, hi)
+                  ON j.ring_hash > r.lo AND j.ring_hash <= r.hi
+                WHERE j.status = 'pending' AND j.ready_at <= CURRENT_TIMESTAMP
+                ORDER BY j.ready_at
+                LIMIT 1
+                FOR UPDATE OF j SKIP LOCKED
+            )
+            RETURNING company_id""",
+                (self.node_id, [lo for lo, _ in ranges], [hi for _, hi in ranges]),
+            )
+            row = cur.fetchone()
+        conn.commit()
+        return row[0] if row else None
+
+    def finish(self, conn, cid, result):
+        """依結果將公司標記為完成、失敗，或依 RETRY_POLICIES 退避後重新排入
+
+        與 RetryScheduler 相同，重試預算依失敗類別各自計算 (failure_counts)；attempts 為總嘗試次數。
+        只更新仍由本節點認領中的工作：心跳中斷期間工作可能已被退回並由其他節點認領，
+        此時保留對方的狀態並返回 "lost"。
+        """
+        failure = result["failure"]
+        status, delay = "done", 0
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT attempts, failure_counts FROM scrape_jobs "
+                "WHERE company_id = %s AND node_id = %s AND status = 'running' FOR UPDATE",
+                (cid, self.node_id),
+            )
+            row = cur.fetchone()
+            if row is None:
+                conn.commit()
+                logging.warning(f"[node {self.node_id}] 公司 {cid} 已不由本節點認領，結果不寫入工作佇列")
+                return "lost"
+            attempts, failure_counts = row[0] + 1, row[1]
+            n = 0
+            if failure and failure != "not_found":
+                policy = RETRY_POLICIES.get(failure, RETRY_POLICIES["other"])
+                n = failure_counts[failure] = failure_counts.get(failure, 0) + 1
+                if n <= policy["max_retries"]:
+                    status, delay = "pending", retry_delay(policy, n)
+                else:
+                    status = "failed"
+            cur.execute(
+                "UPDATE scrape_jobs SET status = %s, node_id = CASE WHEN %s = 'pending' THEN NULL ELSE node_id END, "
+                "attempts = %s, failure = %s, failure_counts = %s, updated_at = CURRENT_TIMESTAMP, "
+                "ready_at = CURRENT_TIMESTAMP + %s * INTERVAL '1 second' "
+                "WHERE company_id = %s AND node_id = %s AND status = 'running'",
+                (status, status, attempts, failure, json.dumps(failure_counts), delay, cid, self.node_id),
+            )
+        conn.commit()
+        if status == "pending":
+            logging.info(f"[node {self.node_id}] 公司 {cid} 發生 {failure} 失敗 (第 {n} 次)，{delay:.1f} 秒後重試")
+        elif status == "failed":
+            logging.warning(f"[node {self.node_id}] 公司 {cid} 的 {failure} 失敗已達上限 ({policy['max_retries']} 次重試)")
+        return status
+
+    def remaining(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM scrape_jobs WHERE status IN ('pending', 'running')")
+            return cur.fetchone()[0]
+
+    def run(self, poll_interval=5, forever=False):
+        """持續認領並爬取本節點區段內的公司；佇列清空後結束 (forever 時持續等待新工作)"""
+        conn = connect_to_postgres()
+        if not conn:
+            return None
+        heartbeat_conn = connect_to_postgres()
+        if not heartbeat_conn:
+            logging.error(f"[node {self.node_id}] 無法建立心跳連線，節點不啟動")
+            conn.close()
+            return None
+        self.register(conn)
+        self.last_heartbeat = time.monotonic()
+        heartbeat = threading.Thread(
+            target=self._heartbeat_loop, args=(heartbeat_conn,), name="node-heartbeat", daemon=True
+        )
+        heartbeat.start()
+        WATCHDOG.start()
+        counts = {}
+        paused = False
+        try:
+            while True:
+                # 心跳中斷時不認領新工作：其他節點很快會接手本節點的區段
+                if self.heartbeat_stale():
+                    if not paused:
+                        logging.error(f"[node {self.node_id}] 心跳持續失敗，暫停認領直到心跳恢復")
+                        paused = True
+                    time.sleep(poll_interval)
+                    continue
+                if paused:
+                    logging.info(f"[node {self.node_id}] 心跳已恢復，繼續認領")
+                    paused = False
+                self.refresh_ring(conn)
+                cid = self.claim(conn)
+                if cid is None:
+                    if not forever and self.remaining(conn) == 0:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                self.bucket.acquire()
+                try:
+                    result = extract_company_data(
+                        cid, self.download_dir, True, self.record_dir, max_page_attempts=1, captcha_attempts=1
+                    )
+                except Exception as e:
+                    logging.error(f"[node {self.node_id}] 處理公司 {cid} 時發生未捕獲的異常：{e}", exc_info=True)
+                    result = {"status": "error", "basic": None, "grades": [], "failure": classify_failure(e)}
+                status = self.finish(conn, cid, result)
+                counts[status] = counts.get(status, 0) + 1
+                self.completed += 1
+        finally:
+            self._stop.set()
+            heartbeat.join()
+            try:
+                self.leave(conn)
+            except Exception as e:
+                logging.warning(f"[node {self.node_id}] 離開時更新節點記錄失敗：{e}")
+                conn.rollback()
+            conn.close()
+
+        logging.info(f"[node {self.node_id}] 結束：處理 {self.completed} 次，結果 {counts}")
+        return counts
+
+
+def node_main(argv):
+    """node 子命令：以分散爬取節點身分執行"""
+    import argparse
+
+    p = argparse.ArgumentParser(prog="scrape_and_print.py node", description="多節點分散爬取 (透過 PostgreSQL 協調)")
+    p.add_argument("company_ids", nargs="*", help="加入工作佇列的統一編號 (任何節點都可加入)")
+    p.add_argument("--node-id", default=f"{socket.gethostname()}-{os.getpid()}", help="節點名稱 (預設為主機名稱-PID)")
+    p.add_argument("--output", "-o", default="downloads", help="輸出目錄")
+    p.add_argument("--record", metavar="DIR", default=None, help="錄製卡片 HTML 與驗證碼圖片到指定目錄")
+    p.add_argument("--rate", type=float, default=NODE_RATE_PER_MINUTE, help="本節點每分鐘最多爬取的公司數")
+    p.add_argument("--burst", type=int, default=1, help="速率預算最多可累積的公司數")
+    p.add_argument("--vnodes", type=int, default=64, help="每個節點在雜湊環上的虛擬節點數 (所有節點須一致)")
+    p.add_argument("--poll", type=float, default=5, help="沒有可認領的公司時的輪詢間隔秒數")
+    p.add_argument("--forever", action="store_true", help="佇列清空後繼續等待新工作")
+    p.add_argument("--enqueue-only", action="store_true", help="只將統一編號加入工作佇列，不爬取")
+    args = p.parse_args(argv)
+
+    conn = connect_to_postgres()
+    if not conn:
+        return None
+    # 多個節點同時啟動時，以 advisory lock 避免同時建立資料表
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(hashtext('scrape_and_print.create_tables'))")
+    try:
+        create_tables(conn)
+        create_node_tables(conn)
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(hashtext('scrape_and_print.create_tables'))")
+        conn.commit()
+    if args.company_ids:
+        enqueue_companies(conn, args.company_ids)
+    conn.close()
+    if args.enqueue_only:
+        return None
+
+    node = ScrapeNode(
+        args.node_id,
+        args.output,
+        args.record,
+        rate_per_minute=args.rate,
+        burst=args.burst,
+        vnodes=args.vnodes,
+    )
+    return node.run(args.poll, args.forever)
+
+
+# 匯出欄位：(輸出欄位名稱, SQL 運算式, 型別)
+EXPORT_COLUMNS = [
+    ("company_id", "b.company_id", "string"),
+    *[(c, f"b.{c}", "string") for c in _BASIC_COLUMNS],
+    ("fetch_date", "b.fetch_date", "timestamp"),
+    ("status", "b.status", "string"),
+    ("grade_year_month", "g.year_month", "string"),
+    ("grade_year_tw", "g.year_tw", "int"),
+    ("grade_year_ad", "g.year_ad", "int"),
+    ("grade_import_grade", "gi.label", "string"),
+    ("grade_export_grade", "ge.label", "string"),
+]
+
+# 增量匯出 (--since-last) 的狀態檔
+EXPORT_STATE_FILE = os.environ.get("EXPORT_STATE_FILE", "downloads/.export_state.json")
+# 增量匯出的重疊秒數：fetch_date 在寫入前就已決定，匯出開始前取得時間、匯出後才提交的資料
+# 也要在下一次匯出涵蓋，因此水位線取匯出開始時間再往前推 (可能重複匯出少量資料，但不會遺漏)
+EXPORT_OVERLAP_SECONDS = int(os.environ.get("EXPORT_OVERLAP_SECONDS", "600"))
+
+
+class CsvExportWriter:
+    """CSV 匯出 (UTF-8 BOM，方便 Excel 直接開啟中文)"""
+
+    def __init__(self, path, columns):
+        self.f = open(path, "w", newline="", encoding="utf-8-sig")
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetExportWriter:
+    """Parquet 匯出，每個區塊寫成一個 row group"""
+
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        types = {"string": pa.string(), "timestamp": pa.timestamp("us"), "int": pa.int16()}
+        self.pa = pa
+        self.schema = pa.schema([(name, types[t]) for name, _, t in EXPORT_COLUMNS])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, rows):
+        arrays = [
+            self.pa.array([r[i] for r in rows], type=field.type)
+            for i, field in enumerate(self.schema)
+        ]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class XlsxExportWriter:
+    """Excel 匯出 (openpyxl write-only 模式)，超過單一工作表列數上限時自動換頁"""
+
+    MAX_ROWS = 1048576
+
+    def __init__(self, path, columns):
+        from openpyxl import Workbook
+
+        self.path = path
+        self.columns = columns
+        self.wb = Workbook(write_only=True)
+        self._new_sheet()
+
+    def _new_sheet(self):
+        self.ws = self.wb.create_sheet(f"data_{len(self.wb.worksheets) + 1}")
+        self.ws.append(self.columns)
+        self.rows = 1
+
+    def write(self, rows):
+        for r in rows:
+            if self.rows >= self.MAX_ROWS:
+                self._new_sheet()
+            self.ws.append(r)
+            self.rows += 1
+
+    def close(self):
+        self.wb.save(self.path)
+
+
+EXPORT_WRITERS = {
+    "csv": CsvExportWriter,
+    "parquet": ParquetExportWriter,
+    "xlsx": XlsxExportWriter,
+}
+
+
+def export_data(conn, output, fmt=None, since=None, until=None, statuses=None, chunk_size=10000):
+    """以伺服器端游標串流匯出 company_basic 與 company_grade 的合併資料
+
+    每次只在記憶體中保留一個區塊 (chunk_size 列)，返回 (匯出列數, 最大 fetch_date)。
+    """
+    fmt = fmt or os.path.splitext(output)[1].lstrip(".").lower()
+    if fmt not in EXPORT_WRITERS:
+        raise ValueError(f"不支援的匯出格式：{fmt}")
+
+    where, params = [], []
+    if since:
+        where.append("b.fetch_date > %s")
+        params.append(since)
+    if until:
+        where.append("b.fetch_date <= %s")
+        params.append(until)
+    if statuses:
+        where.append("b.status = ANY(%s)")
+        params.append(list(statuses))
+
+    sql = (
+        f"SELECT {', '.join(expr for _, expr, _ in EXPORT_COLUMNS)} "
+        "FROM company_basic b "
+        "LEFT JOIN company_grade g ON g.company_id = b.company_id "
+        "LEFT JOIN grade_level gi ON gi.code = g.import_grade "
+        "LEFT JOIN grade_level ge ON ge.code = g.export_grade"
+        + (f" WHERE {' AND '.join(where)}" if where else "")
+        + " ORDER BY b.company_id, g.year_ad"
+    )
+    fetch_idx = [name for name, _, _ in EXPORT_COLUMNS].index("fetch_date")
+
+    total, max_fetch = 0, None
+    writer = EXPORT_WRITERS[fmt](output, [name for name, _, _ in EXPORT_COLUMNS])
+    try:
+        # 具名游標 = PostgreSQL 伺服器端游標，不會一次把結果全部載入記憶體
+        with conn.cursor(name="export_cursor") as cur:
+            cur.itersize = chunk_size
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                writer.write(rows)
+                total += len(rows)
+                chunk_max = max((r[fetch_idx] for r in rows if r[fetch_idx]), default=None)
+                if chunk_max and (max_fetch is None or chunk_max > max_fetch):
+                    max_fetch = chunk_max
+                logging.info(f"已匯出 {total} 列")
+    finally:
+        writer.close()
+    return total, max_fetch
+
+
+def export_main(argv):
+    """export 子命令：匯出資料到 CSV/Parquet/XLSX"""
+    import argparse
+
+    p = argparse.ArgumentParser(
+        prog="scrape_and_print.py export", description="匯出公司基本資料與實績級距"
+    )
+    p.add_argument("output", help="輸出檔案 (副檔名決定格式：.csv/.parquet/.xlsx)")
+    p.add_argument("--format", "-f", choices=sorted(EXPORT_WRITERS), default=None, help="輸出格式")
+    p.add_argument("--since", default=None, help="只匯出 fetch_date 晚於此時間的資料 (ISO 格式)")
+    p.add_argument("--until", default=None, help="只匯出 fetch_date 不晚於此時間的資料 (ISO 格式)")
+    p.add_argument("--status", action="append", default=None, help="只匯出指定狀態 (可重複指定)")
+    p.add_argument("--since-last", action="store_true", help="只匯出上次匯出之後抓取的資料")
+    p.add_argument("--state-file", default=EXPORT_STATE_FILE, help="增量匯出狀態檔")
+    p.add_argument("--chunk-size", type=int, default=10000, help="每個區塊的列數")
+    args = p.parse_args(argv)
+
+    since = datetime.fromisoformat(args.since) if args.since else None
+    if args.since_last:
+        try:
+            with open(args.state_file, encoding="utf-8") as f:
+                state = json.load(f)
+            last = datetime.fromisoformat(state.get("watermark") or state["last_fetch_date"])
+            since = max(since, last) if since else last
+            logging.info(f"增量匯出：匯出 {last} 之後的資料")
+        except (OSError, KeyError, ValueError):
+            logging.info("找不到增量匯出狀態，將匯出全部資料")
+
+    conn = connect_to_postgres()
+    if not conn:
+        return None
+    try:
+        # 以資料庫時鐘在匯出開始時取得下一次的水位線
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT LOCALTIMESTAMP - %s * INTERVAL '1 second'", (EXPORT_OVERLAP_SECONDS,)
+            )
+            watermark = cur.fetchone()[0]
+        total, _ = export_data(
+            conn,
+            args.output,
+            args.format,
+            since,
+            datetime.fromisoformat(args.until) if args.until else None,
+            args.status,
+            args.chunk_size,
+        )
+    finally:
+        conn.close()
+
+    logging.info(f"匯出完成：{total} 列 -> {args.output}")
+    if args.since_last:
+        os.makedirs(os.path.dirname(os.path.abspath(args.state_file)), exist_ok=True)
+        with open(args.state_file, "w", encoding="utf-8") as f:
+            json.dump({"watermark": watermark.isoformat()}, f)
+    return total
+
+
+class LookupCache:
+    """執行緒安全的 LRU + TTL 快取"""
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (到期時間, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self.data[key]
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+
+# 爬取佇列優先順序：數字越小越優先
+PRIORITY_ON_DEMAND = 0
+PRIORITY_BATCH = 1
+
+
+class ScrapeQueue:
+    """單一背景工作執行緒的爬取佇列
+
+    同一個統一編號同時只會有一個爬取任務，並發的請求共用同一個 Future；
+    即時查詢 (PRIORITY_ON_DEMAND) 會排在批次工作之前。
     """
+
+    def __init__(self, download_dir="downloads", save_to_db=True):
+        self.download_dir = download_dir
+        self.save_to_db = save_to_db
+        self.queue = queue.PriorityQueue()
+        self.inflight = {}  # cid -> (priority, Future)
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.completed = 0
+        self.coalesced = 0
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, cid, priority=PRIORITY_BATCH):
+        """排入爬取任務，返回 Future (結果為 extract_company_data 的返回值)"""
+        with self.lock:
+            if cid in self.inflight:
+                queued_priority, future = self.inflight[cid]
+                self.coalesced += 1
+                if priority >= queued_priority:
+                    return future
+                # 已在批次佇列中的公司被即時查詢，以較高優先順序再排一次
+            else:
+                future = Future()
+            self.inflight[cid] = (priority, future)
+            self.seq += 1
+            self.queue.put((priority, self.seq, cid))
+            return future
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _worker(self):
+        while True:
+            priority, _, cid = self.queue.get()
+            with self.lock:
+                entry = self.inflight.get(cid)
+            if entry is None or entry[1].done():
+                continue  # 已被較高優先順序的重複項目處理
+            future = entry[1]
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = extract_company_data(cid, self.download_dir, self.save_to_db)
+                future.set_result(result)
+            except Exception as e:
+                logging.error(f"[lookup] 爬取公司 {cid} 時發生錯誤：{e}", exc_info=True)
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.inflight.pop(cid, None)
+                    self.completed += 1
+
+
+def load_company_from_db(conn, cid):
+    """從資料庫讀取公司基本資料與級距，返回與 extract_company_data 相同格式的結果；
+    負面快取中的公司返回 status=not_found；沒有資料，或只有 log_error_to_db 留下的
+    錯誤記錄 (status=error、欄位全空) 時返回 None"""
+    basic_cols = [f.name for f in fields(CompanyBasic)]
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT {', '.join(basic_cols)}, status FROM company_basic WHERE company_id = %s",
+            (cid,),
+        )
+        row = cur.fetchone()
+        if row is None:
+            if cached_not_found_ids(conn, [cid]):
+                return {"status": "not_found", "basic": None, "grades": [], "failure": "not_found"}
+            return None
+        if row[-1] == "error" or not any(row[1:-1]):
+            return None
+        basic = CompanyBasic.from_row(v or "" for v in row[:-1])
+
+        cur.execute(
+            "SELECT g.year_month, g.year_tw, g.year_ad, gi.label, ge.label FROM company_grade g "
+            "LEFT JOIN grade_level gi ON gi.code = g.import_grade "
+            "LEFT JOIN grade_level ge ON ge.code = g.export_grade "
+            "WHERE g.company_id = %s ORDER BY g.year_ad",
+            (cid,),
+        )
+        grades = [GradeRow(ym, tw, ad, ig or "", eg or "") for ym, tw, ad, ig, eg in cur.fetchall()]
+
+    return {
+        "status": row[-1],
+        "basic": basic,
+        "grades": grades,
+        "failure": None,
+    }
+
+
+def result_to_dict(cid, result):
+    """將結果轉為可輸出 JSON 的字典"""
+    basic = result.get("basic")
+    return {
+        "company_id": cid,
+        "status": result.get("status"),
+        "basic": {f: getattr(basic, f) for f in basic.__slots__} if basic else None,
+        "grades": [{f: getattr(g, f) for f in g.__slots__} for g in result.get("grades", [])],
+    }
+
+
+class LookupService:
+    """統一編號查詢服務：快取 -> 資料庫 -> 即時爬取"""
+
+    def __init__(self, cache, scrape_queue=None, scrape_timeout=120, db_pool=None):
+        self.cache = cache
+        self.scrape_queue = scrape_queue
+        self.scrape_timeout = scrape_timeout
+        self.db_pool = db_pool
+        # 連線池用完時 getconn 會直接報錯，先以號誌排隊
+        self.db_slots = threading.BoundedSemaphore(db_pool.maxconn) if db_pool else None
+
+    def lookup(self, cid, refresh=False, scrape=True):
+        """返回 (HTTP 狀態碼, 回應內容)"""
+        if not re.fullmatch(r"\d{8}", cid):
+            return 400, {"error": "統一編號格式錯誤"}
+
+        result = None if refresh else self.cache.get(cid)
+        if result is None and not refresh and self.db_pool:
+            with self.db_slots:
+                conn = self.db_pool.getconn()
+                try:
+                    result = load_company_from_db(conn, cid)
+                    conn.rollback()  # 結束唯讀交易，歸還乾淨的連線
+                except Exception as e:
+                    logging.error(f"[lookup] 讀取資料庫失敗：{e}")
+                    conn.rollback()
+                finally:
+                    self.db_pool.putconn(conn)
+            if result is not None:
+                self.cache.put(cid, result)
+
+        if result is None:
+            if not (scrape and self.scrape_queue):
+                return 404, {"company_id": cid, "status": "missing"}
+            future = self.scrape_queue.submit(cid, PRIORITY_ON_DEMAND)
+            try:
+                result = future.result(timeout=self.scrape_timeout)
+            except TimeoutError:
+                return 202, {"company_id": cid, "status": "queued"}
+            except Exception as e:
+                return 502, {"company_id": cid, "status": "error", "error": str(e)}
+            if result.get("basic") or result.get("status") == "not_found":
+                self.cache.put(cid, result)
+            else:
+                # 爬取結束但沒有取得資料，不快取，下次查詢會重新爬取
+                return 502, {"company_id": cid, "status": result.get("status"), "failure": result.get("failure")}
+
+        code = 404 if result.get("status") == "not_found" else 200
+        return code, result_to_dict(cid, result)
+
+    def stats(self):
+        q = self.scrape_queue
+        return {
+            "cache_size": len(self.cache.data),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "scrape_pending": q.pending() if q else 0,
+            "scrape_completed": q.completed if q else 0,
+            "scrape_coalesced": q.coalesced if q else 0,
+            "browser": WATCHDOG.gauges(),
+        }
+
+
+class LookupRequestHandler(BaseHTTPRequestHandler):
+    """GET /company/<統一編號>[?refresh=1&scrape=0]、GET /stats"""
+
+    service = None  # 由 serve_main 設定
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        qs = parse_qs(url.query)
+        m = re.fullmatch(r"/company/([^/]+)", url.path)
+        if m:
+            code, body = self.service.lookup(
+                m.group(1),
+                refresh=qs.get("refresh", ["0"])[0] == "1",
+                scrape=qs.get("scrape", ["1"])[0] != "0",
+            )
+        elif url.path == "/stats":
+            code, body = 200, self.service.stats()
+        else:
+            code, body = 404, {"error": "not found"}
+
+        payload = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.info(f"[lookup] {self.address_string()} {format % args}")
+
+
+def serve_main(argv):
+    """serve 子命令：啟動本機 HTTP 查詢服務"""
+    import argparse
+    from psycopg2.pool import ThreadedConnectionPool
+
+    p = argparse.ArgumentParser(
+        prog="scrape_and_print.py serve", description="統一編號查詢服務 (快取 + 資料庫 + 即時爬取)"
     )
+    p.add_argument("company_ids", nargs="*", help="背景批次爬取的統一編號 (優先順序低於即時查詢)")
+    p.add_argument("--host", default="0.0.0.0", help="監聽位址")
+    p.add_argument("--port", type=int, default=8080, help="監聽埠號")
+    p.add_argument("--output", "-o", default="downloads", help="爬取時的輸出目錄")
+    p.add_argument("--cache-size", type=int, default=10000, help="快取筆數上限")
+    p.add_argument("--cache-ttl", type=int, default=3600, help="快取有效秒數")
+    p.add_argument("--scrape-timeout", type=int, default=120, help="即時爬取的最長等待秒數，逾時返回 202")
+    p.add_argument("--no-scrape", action="store_true", help="資料庫沒有資料時不觸發爬取")
+    args = p.parse_args(argv)
+
+    conn = connect_to_postgres()
+    if not conn:
+        return None
+    create_tables(conn)
+    conn.close()
+
+    scrape_queue = None if args.no_scrape else ScrapeQueue(args.output)
+    WATCHDOG.start()
+    if scrape_queue:
+        for cid in args.company_ids:
+            scrape_queue.submit(cid, PRIORITY_BATCH)
+
+    LookupRequestHandler.service = LookupService(
+        LookupCache(args.cache_size, args.cache_ttl),
+        scrape_queue,
+        args.scrape_timeout,
+        ThreadedConnectionPool(1, 8, **PG_CONFIG),
+    )
+    server = ThreadingHTTPServer((args.host, args.port), LookupRequestHandler)
+    logging.info(f"查詢服務已啟動：http://{args.host}:{args.port}/company/<統一編號>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
+def strip_launcher_args(argv):
+    """去掉開頭重複的直譯器與腳本名稱
+
+    Docker 映像的 ENTRYPOINT 已是 `python scrape_and_print.py`，
+    `docker-compose run scraper python scrape_and_print.py export ...` 會再傳入一次這兩個參數。
+    """
+    argv = list(argv)
+    while argv and (re.fullmatch(r"python[0-9.]*", os.path.basename(argv[0])) or argv[0].endswith(".py")):
+        argv.pop(0)
+    return argv
 
 
 def main():
     """主程式入口點"""
     import argparse
-    import random
 
-    # 診斷環境
-    print_diagnostic_info()
+    argv = strip_launcher_args(sys.argv[1:])
+
+    # 子命令
+    if argv and argv[0] == "export":
+        return export_main(argv[1:])
+    if argv and argv[0] == "serve":
+        return serve_main(argv[1:])
+    if argv and argv[0] == "node":
+        return node_main(argv[1:])
 
     # 命令列參數
     p = argparse.ArgumentParser(description="爬取公司基本資料與實績級距")
@@ -888,7 +3508,33 @@ def main():
     p.add_argument("--no-db", action="store_true", help="不保存到資料庫")
     p.add_argument("--batch", "-b", action="store_true", help="批次處理預設公司列表")
     p.add_argument("--limit", "-l", type=int, default=None, help="限制處理公司數量")
-    args = p.parse_args()
+    p.add_argument("--record", metavar="DIR", default=None, help="錄製卡片 HTML 與驗證碼圖片到指定目錄")
+    p.add_argument("--replay", metavar="DIR", default=None, help="重播錄製目錄 (不啟動瀏覽器)")
+    p.add_argument("--reuse-session", action="store_true", help="批次處理時在同一個瀏覽器會話中連續查詢")
+    p.add_argument("--pipeline", action="store_true", help="批次處理時在背景預先載入下一家公司並辨識驗證碼")
+    p.add_argument("--bench-driver", metavar="N", type=int, default=None, help="比較各 WebDriver 設定檔載入 N 次頁面的延遲與記憶體")
+    p.add_argument("--jsonl", metavar="FILE", default=None, help="將處理結果以 JSON Lines 格式寫入檔案")
+    p.add_argument("--diagnostics", action="store_true", help="啟動前打印環境診斷資訊 (每個容器快取一次)")
+    p.add_argument(
+        "--profile",
+        metavar="DIR",
+        nargs="?",
+        const="downloads/profile",
+        default=None,
+        help="取樣剖析並記錄各階段耗時，輸出 folded stacks 與 JSONL 到指定目錄 (預設 downloads/profile)",
+    )
+    p.add_argument("--trace-webdriver", action="store_true", help="統計每種 WebDriver 指令的次數與耗時")
+    args = p.parse_args(argv)
+
+    # 診斷環境
+    if args.diagnostics or os.environ.get("SCRAPER_DIAGNOSTICS") == "1":
+        print_diagnostic_info()
+
+    if args.bench_driver:
+        return benchmark_driver_profiles(args.bench_driver, args.output)
+
+    if args.replay:
+        return replay_fixtures(args.replay, not args.no_db)
 
     companies_to_query = [
         "22178368",  # 微星科技
@@ -903,53 +3549,72 @@ def main():
     ]
     
     logging.info(f"命令列參數: {args}")
-    
-    # 檢測腳本名稱參數
-    if args.company_ids and (
-        any("py" in id.lower() for id in args.company_ids) or
-        any("." in id for id in args.company_ids)
-    ):
-        logging.warning(f"檢測到疑似腳本名稱的參數: {args.company_ids}，將使用預設公司列表")
-        args.company_ids = []
 
     # 決定要處理的公司
     if args.batch or not args.company_ids:
         # 使用內建公司列表進行批次處理
         logging.info(f"使用預設公司列表進行批次處理")
-        # 根據參數限制公司數量
-        companies_to_process = companies_to_query[:args.limit] if args.limit else companies_to_query
-        logging.info(f"將處理 {len(companies_to_process)} 家公司")
-        batch_process(companies_to_process, args.output, not args.no_db)
+        companies_to_process = companies_to_query
+    else:
+        companies_to_process = args.company_ids
+    # 根據參數限制公司數量
+    if args.limit:
+        companies_to_process = companies_to_process[:args.limit]
+    logging.info(f"將處理 {len(companies_to_process)} 家公司")
 
-    
     # 處理公司資料
     results = {}
-    if len(companies_to_process) > 1:
-        results = batch_process(companies_to_process, args.output, not args.no_db)
-    else:
-        single_result = extract_company_data(companies_to_process[0], args.output, not args.no_db)
-        results = {companies_to_process[0]: single_result}
+    start_profiling(args.profile, args.trace_webdriver)
+    try:
+        if len(companies_to_process) > 1:
+            results = batch_process(
+                companies_to_process,
+                args.output,
+                not args.no_db,
+                args.record,
+                args.reuse_session,
+                args.pipeline,
+            )
+        else:
+            single_result = extract_company_data(
+                companies_to_process[0], args.output, not args.no_db, args.record
+            )
+            results = {companies_to_process[0]: single_result}
+    finally:
+        stop_profiling()
     
     # 報告結果
     logging.info("處理結果摘要:")
     for company_id, result in results.items():
         status = result.get("status", "unknown")
-        basic_count = len(result.get("basic", {}))
+        basic = result.get("basic")
+        basic_count = basic.filled_count() if basic else 0
         grades_count = len(result.get("grades", []))
         logging.info(f"公司 {company_id}: 狀態={status}, 基本資料={basic_count}項, 級距資料={grades_count}筆")
+
+    if args.jsonl:
+        with open(args.jsonl, "a", encoding="utf-8") as f:
+            for company_id, result in results.items():
+                f.write(result_to_json(company_id, result) + "\n")
+        logging.info(f"已將 {len(results)} 筆結果寫入 {args.jsonl}")
     
     return results
 
 
-def print_diagnostic_info():
-    """打印診斷信息用於調試"""
-    logging.info("=== 環境診斷信息 ===")
-    logging.info(f"Python 版本: {sys.version}")
-    logging.info(f"當前目錄: {os.getcwd()}")
-    logging.info(f"環境變數:")
-    for key in ["POSTGRES_HOST", "POSTGRES_PORT", "POSTGRES_DB", "POSTGRES_USER", "DISPLAY"]:
-        logging.info(f"  {key}: {os.environ.get(key, '未設置')}")
-    
+# 診斷資訊快取檔：Chrome/ChromeDriver 版本在同一個容器內不會改變，只需探測一次
+DIAGNOSTICS_CACHE = os.environ.get("SCRAPER_DIAGNOSTICS_CACHE", "/tmp/fbfh_diagnostics.json")
+
+
+def probe_browser_binaries():
+    """探測 Chrome 與 ChromeDriver 的路徑與版本 (會啟動子行程)"""
+    info = {
+        "host": socket.gethostname(),
+        "chrome": None,
+        "chrome_version": None,
+        "chromedriver": None,
+        "chromedriver_version": None,
+    }
+
     # 檢查 Chrome 路徑
     chrome_paths = [
         "/usr/bin/google-chrome",
@@ -958,16 +3623,13 @@ def print_diagnostic_info():
     ]
     for path in chrome_paths:
         if os.path.exists(path):
-            logging.info(f"找到 Chrome 瀏覽器: {path}")
+            info["chrome"] = path
             try:
-                version = os.popen(f"{path} --version").read().strip()
-                logging.info(f"Chrome 版本: {version}")
+                info["chrome_version"] = os.popen(f"{path} --version").read().strip()
             except:
-                logging.warning(f"無法獲取 Chrome 版本")
+                pass
             break
-    else:
-        logging.warning(f"未找到 Chrome 瀏覽器")
-    
+
     # 檢查 ChromeDriver 路徑
     driver_paths = [
         "/usr/local/bin/chromedriver",
@@ -975,23 +3637,77 @@ def print_diagnostic_info():
     ]
     for path in driver_paths:
         if os.path.exists(path):
-            logging.info(f"找到 ChromeDriver: {path}")
+            info["chromedriver"] = path
             try:
-                version = os.popen(f"{path} --version").read().strip()
-                logging.info(f"ChromeDriver 版本: {version}")
+                info["chromedriver_version"] = os.popen(f"{path} --version").read().strip()
             except:
-                logging.warning(f"無法獲取 ChromeDriver 版本")
+                pass
             break
+
+    return info
+
+
+def load_browser_diagnostics():
+    """讀取快取的瀏覽器診斷資訊；快取不存在或屬於其他容器時重新探測"""
+    try:
+        with open(DIAGNOSTICS_CACHE, encoding="utf-8") as f:
+            info = json.load(f)
+        if info.get("host") == socket.gethostname():
+            return info
+    except (OSError, ValueError):
+        pass
+
+    info = probe_browser_binaries()
+    try:
+        with open(DIAGNOSTICS_CACHE, "w", encoding="utf-8") as f:
+            json.dump(info, f)
+    except OSError as e:
+        logging.warning(f"無法寫入診斷快取：{e}")
+    return info
+
+
+def find_xvfb_process():
+    """從 /proc 尋找 Xvfb 行程，返回其命令列，找不到時返回 None"""
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                argv = f.read().split(b"\0")
+        except OSError:
+            continue
+        if argv and os.path.basename(argv[0]) == b"Xvfb":
+            return " ".join(a.decode(errors="replace") for a in argv if a)
+    return None
+
+
+def print_diagnostic_info():
+    """打印診斷信息用於調試"""
+    logging.info("=== 環境診斷信息 ===")
+    logging.info(f"Python 版本: {sys.version}")
+    logging.info(f"當前目錄: {os.getcwd()}")
+    logging.info(f"環境變數:")
+    for key in ["POSTGRES_HOST", "POSTGRES_PORT", "POSTGRES_DB", "POSTGRES_USER", "DISPLAY"]:
+        logging.info(f"  {key}: {os.environ.get(key, '未設置')}")
+
+    info = load_browser_diagnostics()
+    if info["chrome"]:
+        logging.info(f"找到 Chrome 瀏覽器: {info['chrome']}")
+        logging.info(f"Chrome 版本: {info['chrome_version'] or '無法獲取'}")
+    else:
+        logging.warning(f"未找到 Chrome 瀏覽器")
+
+    if info["chromedriver"]:
+        logging.info(f"找到 ChromeDriver: {info['chromedriver']}")
+        logging.info(f"ChromeDriver 版本: {info['chromedriver_version'] or '無法獲取'}")
     else:
         logging.warning(f"未找到 ChromeDriver")
-    
+
     # 檢查 Xvfb
     try:
-        xvfb_process = os.popen("ps -ef | grep Xvfb").read()
-        if "Xvfb :99" in xvfb_process:
-            # 修正：使用字符串的 split 方法並傳入字面量 '\n'，而不是在 f-string 中使用 '\n'
-            first_line = xvfb_process.split('\n')[0]
-            logging.info(f"Xvfb 正在運行: {first_line}")
+        xvfb = find_xvfb_process()
+        if xvfb:
+            logging.info(f"Xvfb 正在運行: {xvfb}")
         else:
             logging.warning(f"未檢測到 Xvfb 運行")
     except:
@@ -0,0 +1,50 @@
+"""命令列參數處理"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scrape_and_print
+from scrape_and_print import strip_launcher_args
+
+
+def test_strip_repeated_entrypoint():
+    # docker-compose run scraper python scrape_and_print.py export ...
+    argv = ["python", "scrape_and_print.py", "export", "downloads/companies.parquet"]
+    assert strip_launcher_args(argv) == ["export", "downloads/companies.parquet"]
+
+
+def test_strip_interpreter_path():
+    argv = ["/usr/local/bin/python3.11", "/app/scrape_and_print.py", "node", "--rate", "4"]
+    assert strip_launcher_args(argv) == ["node", "--rate", "4"]
+
+
+def test_keep_plain_arguments():
+    assert strip_launcher_args(["22099131", "22178368"]) == ["22099131", "22178368"]
+    assert strip_launcher_args(["serve", "--port", "8080"]) == ["serve", "--port", "8080"]
+
+
+def run_main(monkeypatch, subcommand, argv):
+    """以 docker-compose 的參數形式執行 main()，返回子命令收到的參數"""
+    received = []
+    monkeypatch.setattr(scrape_and_print, f"{subcommand}_main", received.append)
+    monkeypatch.setattr(sys, "argv", ["scrape_and_print.py", "python", "scrape_and_print.py", subcommand, *argv])
+    scrape_and_print.main()
+    return received
+
+
+def test_export_through_entrypoint(monkeypatch):
+    argv = ["downloads/delta.xlsx", "--since-last"]
+    assert run_main(monkeypatch, "export", argv) == [argv]
+
+
+def test_serve_through_entrypoint(monkeypatch):
+    argv = ["--port", "8080"]
+    assert run_main(monkeypatch, "serve", argv) == [argv]
+
+
+def test_node_through_entrypoint(monkeypatch):
+    argv = ["--enqueue-only", "22178368", "22099131"]
+    assert run_main(monkeypatch, "node", argv) == [argv]
+    assert run_main(monkeypatch, "node", ["--rate", "4"]) == [["--rate", "4"]]
@@ -0,0 +1,137 @@
+"""多節點分散爬取：雜湊環區段與工作佇列的認領、完成
+
+資料庫測試使用 PG_CONFIG (POSTGRES_* 環境變數) 連線，於臨時 schema 中執行；無法連線時略過。
+"""
+
+import os
+import random
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scrape_and_print
+from scrape_and_print import RING_MAX, HashRing, ScrapeNode, create_node_tables, ring_hash
+
+
+def owners(ring, h):
+    return [node for node in ring.nodes if any(lo < h <= hi for lo, hi in ring.ranges(node))]
+
+
+@pytest.mark.parametrize("nodes", [["a"], ["a", "b"], ["node-1", "node-2", "node-3", "node-4", "node-5"]])
+def test_every_hash_has_exactly_one_owner(nodes):
+    ring = HashRing(nodes, vnodes=16)
+    rng = random.Random(0)
+    samples = [0, RING_MAX] + [h for h, _ in ring.ring] + [h + 1 for h, _ in ring.ring if h < RING_MAX]
+    samples += [ring_hash(f"{i:08d}") for i in range(500)] + [rng.randint(0, RING_MAX) for _ in range(500)]
+    for h in samples:
+        assert len(owners(ring, h)) == 1, h
+
+
+def test_node_leaving_only_moves_its_own_hashes():
+    before = HashRing(["a", "b", "c"], vnodes=16)
+    after = HashRing(["a", "b"], vnodes=16)
+    for i in range(1000):
+        h = ring_hash(f"{i:08d}")
+        old = owners(before, h)[0]
+        if old != "c":
+            assert owners(after, h) == [old]
+
+
+@pytest.fixture
+def conn():
+    conn = scrape_and_print.connect_to_postgres()
+    if conn is None:
+        pytest.skip("無法連線到 PostgreSQL")
+    schema = f"test_nodes_{uuid.uuid4().hex[:8]}"
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"SET search_path TO {schema}")
+    conn.commit()
+    create_node_tables(conn)
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+def make_node(node_id, nodes):
+    node = ScrapeNode(node_id)
+    node.ring = HashRing(nodes)
+    return node
+
+
+def add_job(conn, cid):
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO scrape_jobs (company_id, ring_hash) VALUES (%s, %s)", (cid, ring_hash(cid)))
+    conn.commit()
+
+
+def job(conn, cid):
+    with conn.cursor() as cur:
+        cur.execute("SELECT status, node_id, attempts, failure_counts FROM scrape_jobs WHERE company_id = %s", (cid,))
+        return cur.fetchone()
+
+
+def make_ready(conn, cid):
+    with conn.cursor() as cur:
+        cur.execute("UPDATE scrape_jobs SET ready_at = CURRENT_TIMESTAMP WHERE company_id = %s", (cid,))
+    conn.commit()
+
+
+def test_claim_only_own_shard(conn):
+    a, b = make_node("a", ["a", "b"]), make_node("b", ["a", "b"])
+    cids = [f"{i:08d}" for i in range(20)]
+    for cid in cids:
+        add_job(conn, cid)
+    claimed = {}
+    for node in (a, b):
+        while (cid := node.claim(conn)) is not None:
+            claimed[cid] = node.node_id
+    assert sorted(claimed) == cids
+    for cid, node_id in claimed.items():
+        assert owners(a.ring, ring_hash(cid)) == [node_id]
+
+
+def test_finish_requires_current_claimant(conn):
+    a, b = make_node("a", ["a"]), make_node("b", ["b"])
+    add_job(conn, "12345678")
+    assert a.claim(conn) == "12345678"
+
+    # 節點 a 被視為離線，工作退回後由 b 認領
+    with conn.cursor() as cur:
+        cur.execute("UPDATE scrape_jobs SET status = 'pending', node_id = NULL")
+    conn.commit()
+    assert b.claim(conn) == "12345678"
+
+    success = {"status": "success", "basic": None, "grades": [], "failure": None}
+    assert a.finish(conn, "12345678", success) == "lost"
+    assert job(conn, "12345678")[:2] == ("running", "b")
+    assert b.finish(conn, "12345678", success) == "done"
+    assert job(conn, "12345678")[:2] == ("done", "b")
+
+
+def test_finish_budgets_per_failure_class(conn):
+    node = make_node("a", ["a"])
+    cid = "12345678"
+    add_job(conn, cid)
+    policies = scrape_and_print.RETRY_POLICIES
+
+    def fail(failure):
+        make_ready(conn, cid)
+        assert node.claim(conn) == cid
+        return node.finish(conn, cid, {"status": "error", "basic": None, "grades": [], "failure": failure})
+
+    for _ in range(policies["captcha"]["max_retries"]):
+        assert fail("captcha") == "pending"
+    # 其他類別的失敗不受 captcha 次數影響
+    assert fail("timeout") == "pending"
+    assert job(conn, cid)[3] == {"captcha": policies["captcha"]["max_retries"], "timeout": 1}
+    assert fail("captcha") == "failed"
+    assert job(conn, cid)[2] == policies["captcha"]["max_retries"] + 2
@@ -0,0 +1,54 @@
+"""啟動成本檢查：匯入模組時不應載入瀏覽器、OCR 與資料庫相關的重型套件"""
+
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["selenium", "ddddocr", "onnxruntime", "psycopg2", "PIL", "bs4", "pyarrow", "openpyxl"]
+
+# 匯入 scrape_and_print 本身 (不含 Python 啟動) 的累計時間上限，保留足夠餘裕避免 CI 抖動
+IMPORT_BUDGET_US = 500_000
+
+
+def run_python(*args):
+    return subprocess.run(
+        [sys.executable, *args],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_import_does_not_load_heavy_modules():
+    code = (
+        "import sys, scrape_and_print\n"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    loaded = run_python("-c", code).stdout.strip()
+    assert loaded == "", f"匯入時載入了重型套件：{loaded}"
+
+
+def test_import_time_within_budget():
+    # -X importtime 輸出：import time: self [us] | cumulative | imported package
+    stderr = run_python("-X", "importtime", "-c", "import scrape_and_print").stderr
+    m = re.search(r"^import time:\s+\d+ \|\s+(\d+) \| scrape_and_print$", stderr, re.M)
+    assert m, "找不到 scrape_and_print 的 importtime 記錄"
+    assert int(m.group(1)) < IMPORT_BUDGET_US, f"匯入耗時 {int(m.group(1)) / 1000:.0f} ms"
+
+
+def test_help_does_not_load_heavy_modules():
+    code = (
+        "import sys, runpy\n"
+        "sys.argv = ['scrape_and_print.py', '--help']\n"
+        "try:\n"
+        "    runpy.run_path('scrape_and_print.py', run_name='__main__')\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        f"print('LOADED=' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    last_line = run_python("-c", code).stdout.rstrip("\n").rsplit("\n", 1)[-1]
+    assert last_line == "LOADED=", f"--help 時載入了重型套件：{last_line}"